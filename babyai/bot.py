@@ -1,3 +1,4 @@
+from collections import deque
 from gym_minigrid.minigrid import *
 from babyai.levels.verifier import *
 from babyai.levels.verifier import (ObjDesc, pos_next_to,
@@ -500,6 +501,90 @@ class ExploreSubgoal(Subgoal):
         return True
 
 
+class BreadthFirstSearch:
+    """A breadth first search of the agent's locations, that is only run as far
+    as the positions it is asked about.
+
+    This is pretty much your textbook BFS. The state space is agent's locations,
+    but the current direction is also added to the queue to slightly prioritize
+    going straight over turning. The positions are visited in order, and the
+    search goes on from a position if `expandable` is true at its index in
+    `bot.mission.grid.grid`.
+    """
+
+    def __init__(self, bot, initial_states, expandable):
+        self.bot = bot
+        self.cells = bot.mission.grid.grid
+        self.width = bot.mission.grid.width
+        self.expandable = expandable
+        self.queue = deque((state, None) for state in initial_states)
+        self.visited = [False] * len(self.cells)
+        self.previous_pos = [None] * len(self.cells)
+        # The positions visited so far, in order
+        self.visited_pos = []
+
+    def _visit_next(self):
+        """Visits the next position and returns it, or returns None if there is none."""
+        queue = self.queue
+        while queue:
+            (i, j, di, dj), prev_pos = queue.popleft()
+            index = j * self.width + i
+
+            if self.visited[index]:
+                continue
+
+            self.bot.bfs_step_counter += 1
+
+            self.visited[index] = True
+            self.previous_pos[index] = prev_pos
+            self.visited_pos.append((i, j))
+
+            # Don't expand from cells that were not visually observed,
+            # walls, closed doors, and blockers unless they are ignored
+            if self.expandable[index]:
+                # Location to which the bot can get without turning
+                # are put in the queue first
+                for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
+                    queue.append(((i + k, j + l, k, l), (i, j)))
+
+            return (i, j)
+        return None
+
+    def find(self, accept_fn):
+        """Returns the first position, in the order of the search, that satisfies
+        `accept_fn`, called with the position and its cell, or None."""
+        cells = self.cells
+        width = self.width
+        for i, j in self.visited_pos:
+            if accept_fn((i, j), cells[j * width + i]):
+                return (i, j)
+        while True:
+            pos = self._visit_next()
+            if pos is None or accept_fn(pos, cells[pos[1] * width + pos[0]]):
+                return pos
+
+    def reach(self, pos):
+        """Returns whether the search visits `pos`."""
+        index = pos[1] * self.width + pos[0]
+        while not self.visited[index]:
+            if self._visit_next() is None:
+                return False
+        return True
+
+    def run(self):
+        """Visits all the positions that can be reached."""
+        while self._visit_next() is not None:
+            pass
+
+    def path_to(self, pos):
+        """Returns the path from a visited position `pos` back to the start."""
+        path = []
+        while pos:
+            path.append(pos)
+            pos = self.previous_pos[pos[1] * self.width + pos[0]]
+        return path
+
+
 class Bot:
     """A bot that can solve all BabyAI levels.
 
@@ -531,6 +616,24 @@ class Bot:
         # Visibility mask. True for explored/seen, false for unexplored.
         self.vis_mask = np.zeros(shape=(mission.width, mission.height), dtype=np.bool)
 
+        # For every direction of the agent, the offsets from the agent's position
+        # of the cells of its view, indexed by their coordinates in the view
+        view_size = mission.agent_view_size
+        vis_i, vis_j = np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij')
+        self.view_offsets = []
+        for f_vec in DIR_TO_VEC:
+            r_vec = np.array((-f_vec[1], f_vec[0]))
+            top_left = f_vec * (view_size - 1) - r_vec * (view_size // 2)
+            self.view_offsets.append((top_left[0] - f_vec[0] * vis_j + r_vec[0] * vis_i,
+                                      top_left[1] - f_vec[1] * vis_j + r_vec[1] * vis_i))
+
+        # Which cells the BFS can go on from, computed once per observation, and
+        # the searches from the agent, kept as long as they are valid, see `_get_bfs`
+        self._expandable_cells = None
+        self._bfs_key = None
+        self._bfs = [None, None]
+        self._bfs_checked = False
+
         # Stack of tasks/subtasks to complete (tuples)
         self.stack = []
 
@@ -612,12 +715,7 @@ class Bot:
                 obj_pos = obj_desc.obj_poss[i]
 
                 if self.vis_mask[obj_pos]:
-                    shortest_path_to_obj, _, with_blockers = self._shortest_path(
-                        lambda pos, cell: pos == obj_pos,
-                        try_with_blockers=True
-                    )
-                    assert shortest_path_to_obj is not None
-                    distance_to_obj = len(shortest_path_to_obj)
+                    distance_to_obj, with_blockers = self._distance_from_agent(obj_pos)
 
                     if with_blockers:
                         # The distance should take into account the steps necessary
@@ -628,8 +726,7 @@ class Bot:
                         # and 7 if the agent is carrying something
                         # (turn, drop, turn back, pick,
                         # turn to other direction, drop, turn back)
-                        distance_to_obj = (len(shortest_path_to_obj)
-                                           + (7 if self.mission.carrying else 4))
+                        distance_to_obj += 7 if self.mission.carrying else 4
 
                     # If we looking for a door and we are currently in that cell
                     # that contains the door, it will take us at least 2
@@ -655,36 +752,40 @@ class Bot:
 
         return best_obj, best_pos
 
+    def _distance_from_agent(self, pos):
+        """Returns the length of the path that `_shortest_path` finds to `pos`,
+        with blockers if necessary, and whether it has blockers."""
+        bfs = self._get_bfs(ignore_blockers=False)
+        if bfs.reach(pos):
+            return len(bfs.path_to(pos)) - 1, False
+
+        blocker_bfs = self._get_bfs(ignore_blockers=True)
+        assert blocker_bfs.reach(pos)
+        # The path to a position reachable without blockers, and from there to the agent
+        path = blocker_bfs.path_to(pos)
+        return len(path) - 1 + len(bfs.path_to(path[-1])) - 1, True
+
     def _process_obs(self):
         """Parse the contents of an observation/image and update our state."""
 
-        grid, vis_mask = self.mission.gen_obs_grid()
-
-        view_size = self.mission.agent_view_size
-        pos = self.mission.agent_pos
-        f_vec = self.mission.dir_vec
-        r_vec = self.mission.right_vec
+        # Reuse the visibility mask of the last observation if it is the current one
+        mission_state = (tuple(self.mission.agent_pos), self.mission.agent_dir)
+        if getattr(self.mission, 'obs_vis_mask_state', None) == mission_state:
+            vis_mask = self.mission.obs_vis_mask
+        else:
+            _, vis_mask = self.mission.gen_obs_grid()
 
-        # Compute the absolute coordinates of the top-left corner
-        # of the agent's view area
-        top_left = pos + f_vec * (view_size - 1) - r_vec * (view_size // 2)
+        # The grid, the visibility mask and the agent's state can change
+        self._expandable_cells = None
+        self._bfs_checked = False
 
         # Mark everything in front of us as visible
-        for vis_j in range(0, view_size):
-            for vis_i in range(0, view_size):
-
-                if not vis_mask[vis_i, vis_j]:
-                    continue
-
-                # Compute the world coordinates of this cell
-                abs_i, abs_j = top_left - (f_vec * vis_j) + (r_vec * vis_i)
-
-                if abs_i < 0 or abs_i >= self.vis_mask.shape[0]:
-                    continue
-                if abs_j < 0 or abs_j >= self.vis_mask.shape[1]:
-                    continue
-
-                self.vis_mask[abs_i, abs_j] = True
+        offsets_i, offsets_j = self.view_offsets[self.mission.agent_dir]
+        abs_i = offsets_i + self.mission.agent_pos[0]
+        abs_j = offsets_j + self.mission.agent_pos[1]
+        visible = (vis_mask & (abs_i >= 0) & (abs_i < self.vis_mask.shape[0])
+                   & (abs_j >= 0) & (abs_j < self.vis_mask.shape[1]))
+        self.vis_mask[abs_i[visible], abs_j[visible]] = True
 
     def _remember_current_state(self):
         self.prev_agent_pos = self.mission.agent_pos
@@ -707,67 +808,50 @@ class Bot:
                 return distance
             distance += 1
 
-    def _breadth_first_search(self, initial_states, accept_fn, ignore_blockers):
-        """Performs breadth first search.
-
-        This is pretty much your textbook BFS. The state space is agent's locations,
-        but the current direction is also added to the queue to slightly prioritize
-        going straight over turning.
-
+    def _get_expandable_cells(self, ignore_blockers):
+        """Returns, for every cell in the order of `self.mission.grid.grid`, whether
+        the BFS can go on from it: the cell was observed, and it is empty or an open door,
+        or, if `ignore_blockers`, anything but a wall or a closed door."""
+        if self._expandable_cells is None:
+            # The grid is stored row by row, while `vis_mask` is indexed by (i, j)
+            seen_cells = list(zip(self.vis_mask.T.reshape(-1).tolist(), self.mission.grid.grid))
+            free = [seen and (not cell or (cell.type == 'door' and cell.is_open))
+                    for seen, cell in seen_cells]
+            blockers = [seen and (not cell or (cell.type != 'wall' and (cell.type != 'door' or cell.is_open)))
+                        for seen, cell in seen_cells]
+            self._expandable_cells = (free, blockers)
+        return self._expandable_cells[ignore_blockers]
+
+    def _get_bfs(self, ignore_blockers):
+        """Returns the `BreadthFirstSearch` from the agent. If `ignore_blockers`,
+        the search ignores the blockers and starts from all the positions that
+        the search without blockers can reach.
+
+        A BFS visits the positions in the same order and gives them the same
+        previous position, whichever positions it accepts. All the searches of
+        `_shortest_path` thus continue the same two searches, which are only
+        started again when the agent moves or turns, or when the cells the search
+        can go on from change, e.g. when new cells are seen or a door is opened.
         """
-        self.bfs_counter += 1
-
-        queue = [(state, None) for state in initial_states]
-        grid = self.mission.grid
-        previous_pos = dict()
-
-        while len(queue) > 0:
-            state, prev_pos = queue[0]
-            queue = queue[1:]
-            i, j, di, dj = state
-
-            if (i, j) in previous_pos:
-                continue
-
-            self.bfs_step_counter += 1
-
-            cell = grid.get(i, j)
-            previous_pos[(i, j)] = prev_pos
-
-            # If we reached a position satisfying the acceptance condition
-            if accept_fn((i, j), cell):
-                path = []
-                pos = (i, j)
-                while pos:
-                    path.append(pos)
-                    pos = previous_pos[pos]
-                return path, (i, j), previous_pos
-
-            # If this cell was not visually observed, don't expand from it
-            if not self.vis_mask[i, j]:
-                continue
-
-            if cell:
-                if cell.type == 'wall':
-                    continue
-                # If this is a door
-                elif cell.type == 'door':
-                    # If the door is closed, don't visit neighbors
-                    if not cell.is_open:
-                        continue
-                elif not ignore_blockers:
-                    continue
-
-            # Location to which the bot can get without turning
-            # are put in the queue first
-            for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
-                next_pos = (i + k, j + l)
-                next_dir_vec = (k, l)
-                next_state = (*next_pos, *next_dir_vec)
-                queue.append((next_state, (i, j)))
-
-        # Path not found
-        return None, None, previous_pos
+        if not self._bfs_checked:
+            key = (tuple(self.mission.agent_pos), tuple(self.mission.dir_vec),
+                   self._get_expandable_cells(False), self._get_expandable_cells(True))
+            if key != self._bfs_key:
+                self._bfs_key = key
+                self._bfs = [None, None]
+            self._bfs_checked = True
+
+        if self._bfs[ignore_blockers] is None:
+            if ignore_blockers:
+                bfs = self._get_bfs(ignore_blockers=False)
+                bfs.run()
+                initial_states = [(i, j, 1, 0) for i, j in bfs.visited_pos]
+            else:
+                initial_states = [(*self.mission.agent_pos, *self.mission.dir_vec)]
+            self.bfs_counter += 1
+            self._bfs[ignore_blockers] = BreadthFirstSearch(
+                self, initial_states, self._get_expandable_cells(ignore_blockers))
+        return self._bfs[ignore_blockers]
 
     def _shortest_path(self, accept_fn, try_with_blockers=False):
         """
@@ -775,27 +859,21 @@ class Bot:
         Prefers the paths that avoid blockers for as long as possible.
         """
 
-        # Initial states to visit (BFS)
-        initial_states = [(*self.mission.agent_pos, *self.mission.dir_vec)]
-
-        path = finish = None
+        path = None
         with_blockers = False
-        path, finish, previous_pos = self._breadth_first_search(
-            initial_states, accept_fn, ignore_blockers=False)
-        if not path and try_with_blockers:
+        bfs = self._get_bfs(ignore_blockers=False)
+        finish = bfs.find(accept_fn)
+        if finish is not None:
+            path = bfs.path_to(finish)
+        elif try_with_blockers:
             with_blockers = True
-            path, finish, _ = self._breadth_first_search(
-                [(i, j, 1, 0) for i, j in previous_pos],
-                accept_fn, ignore_blockers=True)
-            if path:
+            blocker_bfs = self._get_bfs(ignore_blockers=True)
+            finish = blocker_bfs.find(accept_fn)
+            if finish is not None:
+                path = blocker_bfs.path_to(finish)
                 # `path` now contains the path to a cell that is reachable without
                 # blockers. Now let's add the path to this cell
-                pos = path[-1]
-                extra_path = []
-                while pos:
-                    extra_path.append(pos)
-                    pos = previous_pos[pos]
-                path = path + extra_path[1:]
+                path = path + bfs.path_to(path[-1])[1:]
 
         if path:
             # And the starting position is not required
@@ -196,66 +196,50 @@ class ImitationLearning(object):
 
         # Memory to be stored
         memories = torch.zeros([len(flat_batch), self.acmodel.memory_size], device=self.device)
-        episode_ids = np.zeros(len(flat_batch))
-        memory = torch.zeros([len(batch), self.acmodel.memory_size], device=self.device)
+        episode_ids = np.zeros(len(flat_batch), dtype=np.int64)
 
         preprocessed_first_obs = self.obss_preprocessor(obss[inds], device=self.device)
         instr_embedding = self.acmodel._get_instr_embedding(preprocessed_first_obs.instr)
 
-        # Loop terminates when every observation in the flat_batch has been handled
-        while True:
-            # taking observations and done located at inds
-            obs = obss[inds]
-            done_step = done[inds]
-            preprocessed_obs = self.obss_preprocessor(obs, device=self.device)
+        # Step all the demonstrations together, args.recurrence steps at a time. step_inds[t, i]
+        # is the index of the t-th frame of the i-th demonstration, or of its last frame if it is shorter
+        starts = np.array(inds)
+        lengths = np.diff(np.append(starts, num_frames))
+        memory = torch.zeros([len(batch), self.acmodel.memory_size], device=self.device)
+        for t in range(0, lengths.max(), self.args.recurrence):
+            steps = np.arange(t, min(t + self.args.recurrence, lengths.max()))[:, None]
+            step_inds = starts + np.minimum(steps, lengths - 1)
+            preprocessed_obs = self.obss_preprocessor(obss[step_inds.reshape(-1)], device=self.device)
             with torch.no_grad():
-                # taking the memory till len(inds), as demos beyond that have already finished
-                new_memory = self.acmodel(
-                    preprocessed_obs,
-                    memory[:len(inds), :], instr_embedding[:len(inds)])['memory']
-
-            memories[inds, :] = memory[:len(inds), :]
-            memory[:len(inds), :] = new_memory
-            episode_ids[inds] = range(len(inds))
-
-            # Updating inds, by removing those indices corresponding to which the demonstrations have finished
-            inds = inds[:len(inds) - sum(done_step)]
-            if len(inds) == 0:
-                break
+                model_results = self.acmodel.forward_sequence(
+                    preprocessed_obs.reshape(*step_inds.shape), memory,
+                    torch.ones(step_inds.shape, device=self.device),
+                    instr_embedding.expand(len(steps), *instr_embedding.shape))
+            memory = model_results['memory']
 
-            # Incrementing the remaining indices
-            inds = [index + 1 for index in inds]
+            valid = steps < lengths
+            memories[step_inds[valid]] = model_results['memories'][torch.tensor(valid, device=self.device)]
+            episode_ids[step_inds[valid]] = np.nonzero(valid)[1]
 
         # Here, actual backprop upto args.recurrence happens
-        final_loss = 0
-        final_entropy, final_policy_loss, final_value_loss = 0, 0, 0
 
         indexes = self.starting_indexes(num_frames)
-        memory = memories[indexes]
-        accuracy = 0
-        total_frames = len(indexes) * self.args.recurrence
-        for _ in range(self.args.recurrence):
-            obs = obss[indexes]
-            preprocessed_obs = self.obss_preprocessor(obs, device=self.device)
-            action_step = action_true[indexes]
-            mask_step = mask[indexes]
-            model_results = self.acmodel(
-                preprocessed_obs, memory * mask_step,
-                instr_embedding[episode_ids[indexes]])
-            dist = model_results['dist']
-            memory = model_results['memory']
-
-            entropy = dist.entropy().mean()
-            policy_loss = -dist.log_prob(action_step).mean()
-            loss = policy_loss - self.args.entropy_coef * entropy
-            action_pred = dist.probs.max(1, keepdim=True)[1]
-            accuracy += float((action_pred == action_step.unsqueeze(1)).sum()) / total_frames
-            final_loss += loss
-            final_entropy += entropy
-            final_policy_loss += policy_loss
-            indexes += 1
-
-        final_loss /= self.args.recurrence
+        step_indexes = indexes + np.arange(self.args.recurrence)[:, None]
+        total_frames = step_indexes.size
+
+        preprocessed_obs = self.obss_preprocessor(obss[step_indexes.reshape(-1)], device=self.device)
+        action_step = action_true[step_indexes]
+        model_results = self.acmodel.forward_sequence(
+            preprocessed_obs.reshape(*step_indexes.shape), memories[indexes], mask[step_indexes],
+            instr_embedding[episode_ids[step_indexes]])
+        dist = model_results['dist']
+
+        # The steps have the same number of frames, so these means are the means over the steps
+        final_entropy = dist.entropy().mean()
+        final_policy_loss = -dist.log_prob(action_step).mean()
+        final_loss = final_policy_loss - self.args.entropy_coef * final_entropy
+        action_pred = dist.probs.max(-1)[1]
+        accuracy = float((action_pred == action_step).sum()) / total_frames
 
         if is_training:
             self.optimizer.zero_grad()
@@ -263,8 +247,8 @@ class ImitationLearning(object):
             self.optimizer.step()
 
         log = {}
-        log["entropy"] = float(final_entropy / self.args.recurrence)
-        log["policy_loss"] = float(final_policy_loss / self.args.recurrence)
+        log["entropy"] = float(final_entropy)
+        log["policy_loss"] = float(final_policy_loss)
         log["accuracy"] = float(accuracy)
 
         return log
@@ -65,6 +65,16 @@ class RoomGridLevel(RoomGrid):
 
         return obs, reward, done, info
 
+    def gen_obs_grid(self):
+        grid, vis_mask = super().gen_obs_grid()
+
+        # Keep the visibility mask of the last observation, with the agent's
+        # state it was computed for, so that the bot does not compute it again
+        self.obs_vis_mask = vis_mask
+        self.obs_vis_mask_state = (tuple(self.agent_pos), self.agent_dir)
+
+        return grid, vis_mask
+
     def update_objs_poss(self, instr=None):
         if instr is None:
             instr = self.instrs
@@ -217,7 +217,99 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
             attention = F.softmax(pre_softmax, dim=1)
             instr_embedding = (instr_embedding * attention[:, :, None]).sum(1)
 
-        x = torch.transpose(torch.transpose(obs.image, 1, 3), 2, 3)
+        x = self._get_image_embedding(obs.image, instr_embedding)
+
+        if self.use_memory:
+            hidden = (memory[:, :self.semi_memory_size], memory[:, self.semi_memory_size:])
+            hidden = self.memory_rnn(x, hidden)
+            embedding = hidden[0]
+            memory = torch.cat(hidden, dim=1)
+        else:
+            embedding = x
+
+        results = self._get_outputs(embedding, instr_embedding)
+        results['memory'] = memory
+        return results
+
+    def forward_sequence(self, obs, memory, mask, instr_embedding=None):
+        """Runs the model on T consecutive steps of B environments. The image
+        and instruction part runs on the T * B frames at once, and only the
+        memory is computed step by step.
+
+        Parameters:
+        ----------
+        obs : TensorBatch
+            the preprocessed observations, with a T x B batch shape
+        memory : torch.Tensor
+            the B x M memory before the first step
+        mask : torch.Tensor
+            the T x B (or T x B x 1) masks the memory is multiplied by before every step
+        instr_embedding : torch.Tensor
+            optionally, the T x B x ... instruction embeddings
+
+        Returns a dict like `forward`, with a T x B batch shape, in which
+        `memory` is the memory after the last step and `memories` is the
+        T x B x M memory before every step (before the mask is applied).
+        In train mode, batch normalization uses the statistics of the T * B frames.
+        """
+        T, B = mask.shape[:2]
+        mask = mask.reshape(T, B, 1)
+
+        if self.use_instr and self.lang_model == "attgru":
+            # The attention over the instruction depends on the memory of every step
+            return self._forward_steps(obs, memory, mask, instr_embedding)
+
+        obs = obs.reshape(T * B)
+        if self.use_instr:
+            if instr_embedding is None:
+                instr_embedding = self._get_instr_embedding(obs.instr)
+            else:
+                instr_embedding = instr_embedding.reshape(T * B, *instr_embedding.shape[2:])
+
+        x = self._get_image_embedding(obs.image, instr_embedding)
+
+        memories = []
+        if self.use_memory:
+            x = x.reshape(T, B, -1)
+            embeddings = []
+            for t in range(T):
+                memories.append(memory)
+                memory = memory * mask[t]
+                hidden = (memory[:, :self.semi_memory_size], memory[:, self.semi_memory_size:])
+                hidden = self.memory_rnn(x[t], hidden)
+                embeddings.append(hidden[0])
+                memory = torch.cat(hidden, dim=1)
+            embedding = torch.stack(embeddings).reshape(T * B, -1)
+        else:
+            memories = [memory] * T
+            embedding = x
+
+        results = self._get_outputs(embedding, instr_embedding)
+        results['dist'] = Categorical(logits=results['dist'].logits.reshape(T, B, -1))
+        results['value'] = results['value'].reshape(T, B)
+        results['extra_predictions'] = {info: prediction.reshape(T, B, *prediction.shape[1:])
+                                        for info, prediction in results['extra_predictions'].items()}
+        results['memory'] = memory
+        results['memories'] = torch.stack(memories)
+        return results
+
+    def _forward_steps(self, obs, memory, mask, instr_embedding=None):
+        """`forward_sequence` computed with one call to `forward` per step."""
+        steps, memories = [], []
+        for t in range(mask.shape[0]):
+            memories.append(memory)
+            step = self(obs[t], memory * mask[t], None if instr_embedding is None else instr_embedding[t])
+            memory = step['memory']
+            steps.append(step)
+        return {'dist': Categorical(logits=torch.stack([step['dist'].logits for step in steps])),
+                'value': torch.stack([step['value'] for step in steps]),
+                'memory': memory,
+                'memories': torch.stack(memories),
+                'extra_predictions': {info: torch.stack([step['extra_predictions'][info] for step in steps])
+                                      for info in steps[0]['extra_predictions']}}
+
+    def _get_image_embedding(self, image, instr_embedding):
+        x = torch.transpose(torch.transpose(image.float(), 1, 3), 2, 3)
 
         if self.arch.startswith("expert_filmcnn"):
             x = self.image_conv(x)
@@ -227,16 +319,9 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
         else:
             x = self.image_conv(x)
 
-        x = x.reshape(x.shape[0], -1)
-
-        if self.use_memory:
-            hidden = (memory[:, :self.semi_memory_size], memory[:, self.semi_memory_size:])
-            hidden = self.memory_rnn(x, hidden)
-            embedding = hidden[0]
-            memory = torch.cat(hidden, dim=1)
-        else:
-            embedding = x
+        return x.reshape(x.shape[0], -1)
 
+    def _get_outputs(self, embedding, instr_embedding):
         if self.use_instr and not "filmcnn" in self.arch:
             embedding = torch.cat((embedding, instr_embedding), dim=1)
 
@@ -251,7 +336,7 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
         x = self.critic(embedding)
         value = x.squeeze(1)
 
-        return {'dist': dist, 'value': value, 'memory': memory, 'extra_predictions': extra_predictions}
+        return {'dist': dist, 'value': value, 'extra_predictions': extra_predictions}
 
     def _get_instr_embedding(self, instr):
         lengths = (instr != 0).sum(1).long()
@@ -1,3 +1,3 @@
 from babyai.rl.algos import PPOAlgo
-from babyai.rl.utils import DictList
+from babyai.rl.utils import DictList, ParallelEnv, ActorPool, TensorBatch, ScaledReward
 from babyai.rl.model import ACModel, RecurrentACModel
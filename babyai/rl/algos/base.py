@@ -3,22 +3,27 @@ import torch
 import numpy
 
 from babyai.rl.format import default_preprocess_obss
-from babyai.rl.utils import DictList, ParallelEnv
+from babyai.rl.utils import ParallelEnv, ActorPool, InstrEmbeddingCache, TensorBatch
 from babyai.rl.utils.supervised_losses import ExtraInfoCollector
+from babyai.rl.utils import returns
+from babyai.rl.utils.reward_shaping import reshape_rewards
 
 
 class BaseAlgo(ABC):
     """The base class for RL algorithms."""
 
     def __init__(self, envs, acmodel, num_frames_per_proc, discount, lr, gae_lambda, entropy_coef,
-                 value_loss_coef, max_grad_norm, recurrence, preprocess_obss, reshape_reward, aux_info):
+                 value_loss_coef, max_grad_norm, recurrence, preprocess_obss, reshape_reward, aux_info,
+                 min_ready=None, advantage_estimator="gae", n_steps=5):
         """
         Initializes a `BaseAlgo` instance.
 
         Parameters:
         ----------
-        envs : list
-            a list of environments that will be run in parallel
+        envs : list or ParallelEnv or ActorPool
+            a list of environments that will be run in parallel, or an
+            already configured `ParallelEnv`, or an `ActorPool` whose actors
+            collect the experiences while the model is updated
         acmodel : torch.Module
             the model
         num_frames_per_proc : int
@@ -43,15 +48,31 @@ class BaseAlgo(ABC):
             and converts them into the format that the model can handle
         reshape_reward : function
             a function that shapes the reward, takes an
-            (observation, action, reward, done) tuple as an input
+            (observation, action, reward, done) tuple as an input.
+            If it has a `batch` method, see `ScaledReward`, the rewards
+            of all the environments are shaped at once
         aux_info : list
             a list of strings corresponding to the name of the extra information
             retrieved from the environment for supervised auxiliary losses
+        min_ready : int
+            if given, the environments are stepped asynchronously: the model
+            is run as soon as at least `min_ready` environments are ready,
+            instead of waiting for all of them at every step
+        advantage_estimator : str
+            how the advantages are computed: "gae", "nstep" (n-step returns)
+            or "vtrace". With an asynchronous `ActorPool`, "vtrace" corrects
+            for the actors' older model, the values and log-probabilities being
+            recomputed with the current model; otherwise PPO's clipping
+            is relative to the actors' model. Otherwise, the experiences are
+            on-policy and "vtrace" has no importance weights
+        n_steps : int
+            the number of steps of the "nstep" returns
 
         """
         # Store parameters
 
-        self.env = ParallelEnv(envs)
+        self.env = envs if isinstance(envs, (ParallelEnv, ActorPool)) else ParallelEnv(envs, aux_info=aux_info)
+        self.actors = isinstance(self.env, ActorPool)
         self.acmodel = acmodel
         self.acmodel.train()
         self.num_frames_per_proc = num_frames_per_proc
@@ -65,22 +86,35 @@ class BaseAlgo(ABC):
         self.preprocess_obss = preprocess_obss or default_preprocess_obss
         self.reshape_reward = reshape_reward
         self.aux_info = aux_info
+        self.min_ready = min_ready
+        self.advantage_estimator = advantage_estimator
+        self.n_steps = n_steps
+        self.instr_cache = InstrEmbeddingCache(acmodel) if getattr(acmodel, 'use_instr', False) else None
 
         # Store helpers values
 
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.num_procs = len(envs)
+        self.num_procs = self.env.num_envs
         self.num_frames = self.num_frames_per_proc * self.num_procs
 
 
         assert self.num_frames_per_proc % self.recurrence == 0
+        assert self.min_ready is None or not self.aux_info, \
+            "asynchronous stepping does not support aux_info"
+        assert not self.actors or (self.min_ready is None and not self.aux_info), \
+            "actors support neither asynchronous stepping nor aux_info"
+        assert self.advantage_estimator in ("gae", "nstep", "vtrace"), \
+            "unknown advantage estimator: {}".format(self.advantage_estimator)
 
         # Initialize experience values
 
         shape = (self.num_frames_per_proc, self.num_procs)
 
-        self.obs = self.env.reset()
-        self.obss = [None]*(shape[0])
+        self.obs = None if self.actors else self.env.reset()
+        # The preprocessed observations, one (T, P, ...) tensor per key,
+        # allocated when the first observations are stored
+        self.obss = TensorBatch(batch_ndim=2)
+        self.obss_shapes = {}
 
         self.memory = torch.zeros(shape[1], self.acmodel.memory_size, device=self.device)
         self.memories = torch.zeros(*shape, self.acmodel.memory_size, device=self.device)
@@ -91,6 +125,7 @@ class BaseAlgo(ABC):
         self.values = torch.zeros(*shape, device=self.device)
         self.rewards = torch.zeros(*shape, device=self.device)
         self.advantages = torch.zeros(*shape, device=self.device)
+        self.returns = torch.zeros(*shape, device=self.device)
         self.log_probs = torch.zeros(*shape, device=self.device)
 
         if self.aux_info:
@@ -116,7 +151,7 @@ class BaseAlgo(ABC):
 
         Returns
         -------
-        exps : DictList
+        exps : TensorBatch
             Contains actions, rewards, advantages etc as attributes.
             Each attribute, e.g. `exps.reward` has a shape
             (self.num_frames_per_proc * num_envs, ...). k-th block
@@ -128,12 +163,107 @@ class BaseAlgo(ABC):
             reward, policy loss, value loss, etc.
 
         """
+        self.obss_shapes = {}
+        if self.actors:
+            preprocessed_obs = self._collect_rollouts_from_actors()
+        else:
+            if self.min_ready is None:
+                self._collect_rollouts()
+            else:
+                self._collect_rollouts_async()
+            preprocessed_obs = self.preprocess_obss(self.obs, device=self.device)
+
+        # Add advantage and return to experiences
+
+        log_rhos = torch.zeros_like(self.log_probs)
+        if self.actors and self.advantage_estimator == "vtrace":
+            # The actors may have used an older model. The model is evaluated in eval
+            # mode, so that the batch norm statistics are not updated with the rollout
+            self.acmodel.eval()
+            with torch.no_grad():
+                model_results = self.acmodel.forward_sequence(self.obss, self.memories[0], self.masks)
+            self.acmodel.train()
+            log_probs = model_results['dist'].log_prob(self.actions)
+            log_rhos = log_probs - self.log_probs
+            self.values = model_results['value']
+            self.log_probs = log_probs
+
+        with torch.no_grad():
+            next_value = self.acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1),
+                                      self._get_instr_embedding(preprocessed_obs))['value']
+
+        next_masks = torch.cat((self.masks[1:], self.mask.unsqueeze(0)))
+        if self.advantage_estimator == "gae":
+            self.advantages = returns.compute_gae(self.rewards, self.values, next_masks, next_value,
+                                                  self.discount, self.gae_lambda)
+            self.returns = self.values + self.advantages
+        elif self.advantage_estimator == "nstep":
+            self.advantages = returns.compute_nstep_advantages(self.rewards, self.values, next_masks, next_value,
+                                                               self.discount, self.n_steps)
+            self.returns = self.values + self.advantages
+        else:
+            self.returns, self.advantages = returns.compute_vtrace(
+                self.rewards, self.values, next_masks, next_value, log_rhos, self.discount)
+
+        # Flatten the data correctly, making sure that
+        # each episode's data is a continuous chunk
+
+        exps = TensorBatch()
+        # In commments below T is self.num_frames_per_proc, P is self.num_procs,
+        # D is the dimensionality
+
+        # T x P x D -> P x T x D -> (P * T) x D, for every observation key,
+        # dropping the padding beyond the observations of this rollout
+        exps.obs = TensorBatch()
+        for key, storage in self.obss.items():
+            shape = self.obss_shapes[key]
+            storage = storage[(slice(None), slice(None)) + tuple(slice(0, n) for n in shape)]
+            exps.obs[key] = storage.transpose(0, 1).reshape(-1, *shape)
+
+        # T x P x D -> P x T x D -> (P * T) x D
+        exps.memory = self.memories.transpose(0, 1).reshape(-1, *self.memories.shape[2:])
+        # T x P -> P x T -> (P * T) x 1
+        exps.mask = self.masks.transpose(0, 1).reshape(-1).unsqueeze(1)
+
+        # for all tensors below, T x P -> P x T -> P * T
+        exps.action = self.actions.transpose(0, 1).reshape(-1)
+        exps.value = self.values.transpose(0, 1).reshape(-1)
+        exps.reward = self.rewards.transpose(0, 1).reshape(-1)
+        exps.advantage = self.advantages.transpose(0, 1).reshape(-1)
+        exps.returnn = self.returns.transpose(0, 1).reshape(-1)
+        exps.log_prob = self.log_probs.transpose(0, 1).reshape(-1)
+
+        if self.aux_info:
+            exps = self.aux_info_collector.end_collection(exps)
+
+        # Log some values
+
+        keep = max(self.log_done_counter, self.num_procs)
+
+        log = {
+            "return_per_episode": self.log_return[-keep:],
+            "reshaped_return_per_episode": self.log_reshaped_return[-keep:],
+            "num_frames_per_episode": self.log_num_frames[-keep:],
+            "num_frames": self.num_frames,
+            "episodes_done": self.log_done_counter,
+        }
+
+        self.log_done_counter = 0
+        self.log_return = self.log_return[-self.num_procs:]
+        self.log_reshaped_return = self.log_reshaped_return[-self.num_procs:]
+        self.log_num_frames = self.log_num_frames[-self.num_procs:]
+
+        return exps, log
+
+    def _collect_rollouts(self):
+        """Fills the experience buffers by stepping all the environments together."""
         for i in range(self.num_frames_per_proc):
             # Do one agent-environment interaction
 
             preprocessed_obs = self.preprocess_obss(self.obs, device=self.device)
             with torch.no_grad():
-                model_results = self.acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1))
+                model_results = self.acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1),
+                                             self._get_instr_embedding(preprocessed_obs))
                 dist = model_results['dist']
                 value = model_results['value']
                 memory = model_results['memory']
@@ -144,11 +274,10 @@ class BaseAlgo(ABC):
             obs, reward, done, env_info = self.env.step(action.cpu().numpy())
             if self.aux_info:
                 env_info = self.aux_info_collector.process(env_info)
-                # env_info = self.process_aux_info(env_info)
 
             # Update experiences values
 
-            self.obss[i] = self.obs
+            self._store_obs(i, slice(None), preprocessed_obs)
             self.obs = obs
 
             self.memories[i] = self.memory
@@ -159,10 +288,7 @@ class BaseAlgo(ABC):
             self.actions[i] = action
             self.values[i] = value
             if self.reshape_reward is not None:
-                self.rewards[i] = torch.tensor([
-                    self.reshape_reward(obs_, action_, reward_, done_)
-                    for obs_, action_, reward_, done_ in zip(obs, action, reward, done)
-                ], device=self.device)
+                self.rewards[i] = reshape_rewards(self.reshape_reward, obs, action, reward, done, self.device)
             else:
                 self.rewards[i] = torch.tensor(reward, device=self.device)
             self.log_probs[i] = dist.log_prob(action)
@@ -176,79 +302,148 @@ class BaseAlgo(ABC):
             self.log_episode_reshaped_return += self.rewards[i]
             self.log_episode_num_frames += torch.ones(self.num_procs, device=self.device)
 
-            for i, done_ in enumerate(done):
-                if done_:
-                    self.log_done_counter += 1
-                    self.log_return.append(self.log_episode_return[i].item())
-                    self.log_reshaped_return.append(self.log_episode_reshaped_return[i].item())
-                    self.log_num_frames.append(self.log_episode_num_frames[i].item())
+            self._log_done_episodes(slice(None), done)
 
             self.log_episode_return *= self.mask
             self.log_episode_reshaped_return *= self.mask
             self.log_episode_num_frames *= self.mask
 
-        # Add advantage and return to experiences
-
-        preprocessed_obs = self.preprocess_obss(self.obs, device=self.device)
-        with torch.no_grad():
-            next_value = self.acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1))['value']
-
-        for i in reversed(range(self.num_frames_per_proc)):
-            next_mask = self.masks[i+1] if i < self.num_frames_per_proc - 1 else self.mask
-            next_value = self.values[i+1] if i < self.num_frames_per_proc - 1 else next_value
-            next_advantage = self.advantages[i+1] if i < self.num_frames_per_proc - 1 else 0
-
-            delta = self.rewards[i] + self.discount * next_value * next_mask - self.values[i]
-            self.advantages[i] = delta + self.discount * self.gae_lambda * next_advantage * next_mask
-
-        # Flatten the data correctly, making sure that
-        # each episode's data is a continuous chunk
-
-        exps = DictList()
-        exps.obs = [self.obss[i][j]
-                    for j in range(self.num_procs)
-                    for i in range(self.num_frames_per_proc)]
-        # In commments below T is self.num_frames_per_proc, P is self.num_procs,
-        # D is the dimensionality
-
-        # T x P x D -> P x T x D -> (P * T) x D
-        exps.memory = self.memories.transpose(0, 1).reshape(-1, *self.memories.shape[2:])
-        # T x P -> P x T -> (P * T) x 1
-        exps.mask = self.masks.transpose(0, 1).reshape(-1).unsqueeze(1)
-
-        # for all tensors below, T x P -> P x T -> P * T
-        exps.action = self.actions.transpose(0, 1).reshape(-1)
-        exps.value = self.values.transpose(0, 1).reshape(-1)
-        exps.reward = self.rewards.transpose(0, 1).reshape(-1)
-        exps.advantage = self.advantages.transpose(0, 1).reshape(-1)
-        exps.returnn = exps.value + exps.advantage
-        exps.log_prob = self.log_probs.transpose(0, 1).reshape(-1)
-
-        if self.aux_info:
-            exps = self.aux_info_collector.end_collection(exps)
-
-        # Preprocess experiences
+    def _collect_rollouts_async(self):
+        """Fills the experience buffers by running the model on the environments
+        that are ready first. Every environment still contributes exactly
+        `self.num_frames_per_proc` consecutive frames, but a slow environment
+        only delays its own frames."""
+        num_steps = numpy.zeros(self.num_procs, dtype=numpy.int64)
 
-        exps.obs = self.preprocess_obss(exps.obs, device=self.device)
+        self._act_async(numpy.arange(self.num_procs), num_steps)
 
-        # Log some values
+        while (num_steps < self.num_frames_per_proc).any():
+            obs, reward, done, _, env_ids = self.env.recv(self.min_ready)
+            env_ids = numpy.array(env_ids)
+            steps = num_steps[env_ids]
+            ids = torch.tensor(env_ids, device=self.device)
+            t = torch.tensor(steps, device=self.device)
 
-        keep = max(self.log_done_counter, self.num_procs)
+            # Update experiences values
 
-        log = {
-            "return_per_episode": self.log_return[-keep:],
-            "reshaped_return_per_episode": self.log_reshaped_return[-keep:],
-            "num_frames_per_episode": self.log_num_frames[-keep:],
-            "num_frames": self.num_frames,
-            "episodes_done": self.log_done_counter,
-        }
+            if self.env.batched_obs:
+                self.obs[env_ids] = obs
+            else:
+                for env_id, obs_ in zip(env_ids, obs):
+                    self.obs[env_id] = obs_
+            self.mask[ids] = 1 - torch.tensor(done, device=self.device, dtype=torch.float)
+            if self.reshape_reward is not None:
+                self.rewards[t, ids] = reshape_rewards(self.reshape_reward, obs, self.actions[t, ids],
+                                                       reward, done, self.device)
+            else:
+                self.rewards[t, ids] = torch.tensor(reward, device=self.device, dtype=torch.float)
 
-        self.log_done_counter = 0
-        self.log_return = self.log_return[-self.num_procs:]
-        self.log_reshaped_return = self.log_reshaped_return[-self.num_procs:]
-        self.log_num_frames = self.log_num_frames[-self.num_procs:]
+            # Update log values
 
-        return exps, log
+            self.log_episode_return[ids] += torch.tensor(reward, device=self.device, dtype=torch.float)
+            self.log_episode_reshaped_return[ids] += self.rewards[t, ids]
+            self.log_episode_num_frames[ids] += 1
+
+            self._log_done_episodes(ids, done)
+
+            self.log_episode_return[ids] *= self.mask[ids]
+            self.log_episode_reshaped_return[ids] *= self.mask[ids]
+            self.log_episode_num_frames[ids] *= self.mask[ids]
+
+            num_steps[env_ids] += 1
+            active = num_steps[env_ids] < self.num_frames_per_proc
+            if active.any():
+                self._act_async(env_ids[active], num_steps[env_ids[active]])
+
+    def _collect_rollouts_from_actors(self):
+        """Sends the current weights to the actors and fills the experience buffers
+        with their next rollouts. Returns the preprocessed observations that follow."""
+        self.env.update_weights(self.acmodel)
+        rollout = self.env.get_rollout()
+
+        self.obss = rollout["obs"].to(self.device)
+        self.obss_shapes = {key: value.shape[2:] for key, value in self.obss.items()}
+        self.memories = rollout["memory"].to(self.device)
+        self.masks = rollout["mask"].to(self.device)
+        self.actions = rollout["action"].to(self.device)
+        self.values = rollout["value"].to(self.device)
+        self.rewards = rollout["reward"].to(self.device)
+        self.log_probs = rollout["log_prob"].to(self.device)
+        self.memory = rollout["next_memory"].to(self.device)
+        self.mask = rollout["next_mask"].to(self.device)
+
+        # Update log values
+
+        self.log_done_counter += len(rollout["log"]["return_per_episode"])
+        self.log_return.extend(rollout["log"]["return_per_episode"])
+        self.log_reshaped_return.extend(rollout["log"]["reshaped_return_per_episode"])
+        self.log_num_frames.extend(rollout["log"]["num_frames_per_episode"])
+
+        return rollout["next_obs"].to(self.device)
+
+    def _act_async(self, env_ids, steps):
+        """Runs the model on the environments `env_ids`, records the results
+        as their frames number `steps` and sends the actions to the environments."""
+        ids = torch.tensor(env_ids, device=self.device)
+        t = torch.tensor(steps, device=self.device)
+
+        if self.env.batched_obs:
+            obs = self.obs[env_ids]
+        else:
+            obs = [self.obs[env_id] for env_id in env_ids]
+        preprocessed_obs = self.preprocess_obss(obs, device=self.device)
+        with torch.no_grad():
+            model_results = self.acmodel(preprocessed_obs, self.memory[ids] * self.mask[ids].unsqueeze(1),
+                                         self._get_instr_embedding(preprocessed_obs))
+            dist = model_results['dist']
+            value = model_results['value']
+            memory = model_results['memory']
+
+        action = dist.sample()
+
+        self.env.send(action.cpu().numpy(), env_ids)
+
+        self._store_obs(t, ids, preprocessed_obs)
+        self.memories[t, ids] = self.memory[ids]
+        self.memory[ids] = memory
+        self.masks[t, ids] = self.mask[ids]
+        self.actions[t, ids] = action.int()
+        self.values[t, ids] = value
+        self.log_probs[t, ids] = dist.log_prob(action)
+
+    def _log_done_episodes(self, ids, done):
+        """Logs the returns and lengths of the episodes of the environments `ids` that are done."""
+        done = torch.tensor(done, device=self.device, dtype=torch.bool)
+        self.log_done_counter += int(done.sum())
+        self.log_return.extend(self.log_episode_return[ids][done].tolist())
+        self.log_reshaped_return.extend(self.log_episode_reshaped_return[ids][done].tolist())
+        self.log_num_frames.extend(self.log_episode_num_frames[ids][done].tolist())
+
+    def _get_instr_embedding(self, preprocessed_obs):
+        """Returns the cached instruction embeddings of the observations, or `None`
+        if the model does not use instructions, in which case it computes nothing."""
+        if self.instr_cache is None:
+            return None
+        return self.instr_cache(preprocessed_obs.instr)
+
+    def _store_obs(self, t, ids, preprocessed_obs):
+        """Writes the preprocessed observations of the environments `ids` as
+        their frames `t`. The storage of a key is reallocated when a tensor
+        does not fit in it, e.g. when an instruction is longer than all the
+        previous ones, and the unused part of a frame is zeroed, i.e. padded."""
+        for key, value in preprocessed_obs.items():
+            shape = tuple(max(n, m) for n, m in zip(self.obss_shapes.get(key, value.shape[1:]), value.shape[1:]))
+            self.obss_shapes[key] = shape
+            storage = self.obss.get(key)
+            if storage is None or storage.dtype != value.dtype \
+                    or any(n > m for n, m in zip(shape, storage.shape[2:])):
+                new_storage = torch.zeros(self.num_frames_per_proc, self.num_procs, *shape,
+                                          device=self.device, dtype=value.dtype)
+                if storage is not None and storage.dtype == value.dtype:
+                    new_storage[(slice(None), slice(None)) + tuple(slice(0, n) for n in storage.shape[2:])] = storage
+                self.obss[key] = storage = new_storage
+            storage[t, ids] = 0
+            storage[(t, ids) + tuple(slice(0, n) for n in value.shape[1:])] = value
 
     @abstractmethod
     def update_parameters(self):
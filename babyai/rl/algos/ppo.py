@@ -4,6 +4,8 @@ import torch.nn.functional as F
 
 
 from babyai.rl.algos.base import BaseAlgo
+from babyai.rl.utils import get_unique_instr_embedding
+from babyai.rl.utils.distributed import broadcast_model, all_reduce_gradients, all_reduce_buffers
 
 
 class PPOAlgo(BaseAlgo):
@@ -14,12 +16,13 @@ class PPOAlgo(BaseAlgo):
                  gae_lambda=0.95,
                  entropy_coef=0.01, value_loss_coef=0.5, max_grad_norm=0.5, recurrence=4,
                  adam_eps=1e-5, clip_eps=0.2, epochs=4, batch_size=256, preprocess_obss=None,
-                 reshape_reward=None, aux_info=None):
+                 reshape_reward=None, aux_info=None, min_ready=None, advantage_estimator="gae", n_steps=5,
+                 distributed=False):
         num_frames_per_proc = num_frames_per_proc or 128
 
         super().__init__(envs, acmodel, num_frames_per_proc, discount, lr, gae_lambda, entropy_coef,
                          value_loss_coef, max_grad_norm, recurrence, preprocess_obss, reshape_reward,
-                         aux_info)
+                         aux_info, min_ready, advantage_estimator, n_steps)
 
         self.clip_eps = clip_eps
         self.epochs = epochs
@@ -28,6 +31,12 @@ class PPOAlgo(BaseAlgo):
         assert self.batch_size % self.recurrence == 0
 
         self.optimizer = torch.optim.Adam(self.acmodel.parameters(), lr, (beta1, beta2), eps=adam_eps)
+
+        # If `distributed`, this is one of the learners of the `torch.distributed` process
+        # group, and the gradients are averaged with the other learners
+        self.distributed = distributed
+        if self.distributed:
+            broadcast_model(self.acmodel)
         self.batch_num = 0
 
     def update_parameters(self):
@@ -35,14 +44,14 @@ class PPOAlgo(BaseAlgo):
 
         exps, logs = self.collect_experiences()
         '''
-        exps is a DictList with the following keys ['obs', 'memory', 'mask', 'action', 'value', 'reward',
+        exps is a TensorBatch with the following keys ['obs', 'memory', 'mask', 'action', 'value', 'reward',
          'advantage', 'returnn', 'log_prob'] and ['collected_info', 'extra_predictions'] if we use aux_info
-        exps.obs is a DictList with the following keys ['image', 'instr']
-        exps.obj.image is a (n_procs * n_frames_per_proc) x image_size 4D tensor
+        exps.obs is a TensorBatch with the following keys ['image', 'instr']
+        exps.obj.image is a (n_procs * n_frames_per_proc) x image_size 4D uint8 tensor
         exps.obs.instr is a (n_procs * n_frames_per_proc) x (max number of words in an instruction) 2D tensor
         exps.memory is a (n_procs * n_frames_per_proc) x (memory_size = 2*image_embedding_size) 2D tensor
         exps.mask is (n_procs * n_frames_per_proc) x 1 2D tensor
-        if we use aux_info: exps.collected_info and exps.extra_predictions are DictLists with keys
+        if we use aux_info: exps.collected_info and exps.extra_predictions are TensorBatches with keys
         being the added information. They are either (n_procs * n_frames_per_proc) 1D tensors or
         (n_procs * n_frames_per_proc) x k 2D tensors where k is the number of classes for multiclass classification
         '''
@@ -65,72 +74,57 @@ class PPOAlgo(BaseAlgo):
             list of frames is random thanks to self._get_batches_starting_indexes().
             '''
 
-            for inds in self._get_batches_starting_indexes():
-                # inds is a numpy array of indices that correspond to the beginning of a sub-batch
-                # there are as many inds as there are batches
-                # Initialize batch values
-
-                batch_entropy = 0
-                batch_value = 0
-                batch_policy_loss = 0
-                batch_value_loss = 0
-                batch_loss = 0
+            for batch in self._get_batches(exps):
+                # batch is laid out as recurrence x (batch_size / recurrence) x ..., batch[i] being
+                # the i-th sub-batch, i.e. the i-th frame after every starting index
 
                 # Initialize memory
 
-                memory = exps.memory[inds]
-
-                for i in range(self.recurrence):
-                    # Create a sub-batch of experience
-                    sb = exps[inds + i]
+                memory = batch.memory[0]
 
-                    # Compute loss
+                # Embed every distinct instruction of the batch once
 
-                    model_results = self.acmodel(sb.obs, memory * sb.mask)
-                    dist = model_results['dist']
-                    value = model_results['value']
-                    memory = model_results['memory']
-                    extra_predictions = model_results['extra_predictions']
+                instr_embedding = None
+                if self.instr_cache is not None:
+                    instr_embedding = get_unique_instr_embedding(
+                        self.acmodel, batch.obs.instr.reshape(-1, batch.obs.instr.shape[-1]))
+                    instr_embedding = instr_embedding.reshape(*batch.shape, *instr_embedding.shape[1:])
 
-                    entropy = dist.entropy().mean()
+                # Compute loss, over the sub-batches of all the steps of the recurrence at once
 
-                    ratio = torch.exp(dist.log_prob(sb.action) - sb.log_prob)
-                    surr1 = ratio * sb.advantage
-                    surr2 = torch.clamp(ratio, 1.0 - self.clip_eps, 1.0 + self.clip_eps) * sb.advantage
-                    policy_loss = -torch.min(surr1, surr2).mean()
+                model_results = self.acmodel.forward_sequence(batch.obs, memory, batch.mask, instr_embedding)
+                dist = model_results['dist']
+                value = model_results['value']
 
-                    value_clipped = sb.value + torch.clamp(value - sb.value, -self.clip_eps, self.clip_eps)
-                    surr1 = (value - sb.returnn).pow(2)
-                    surr2 = (value_clipped - sb.returnn).pow(2)
-                    value_loss = torch.max(surr1, surr2).mean()
+                entropy = dist.entropy().mean()
 
-                    loss = policy_loss - self.entropy_coef * entropy + self.value_loss_coef * value_loss
+                ratio = torch.exp(dist.log_prob(batch.action) - batch.log_prob)
+                surr1 = ratio * batch.advantage
+                surr2 = torch.clamp(ratio, 1.0 - self.clip_eps, 1.0 + self.clip_eps) * batch.advantage
+                policy_loss = -torch.min(surr1, surr2).mean()
 
-                    # Update batch values
+                value_clipped = batch.value + torch.clamp(value - batch.value, -self.clip_eps, self.clip_eps)
+                surr1 = (value - batch.returnn).pow(2)
+                surr2 = (value_clipped - batch.returnn).pow(2)
+                value_loss = torch.max(surr1, surr2).mean()
 
-                    batch_entropy += entropy.item()
-                    batch_value += value.mean().item()
-                    batch_policy_loss += policy_loss.item()
-                    batch_value_loss += value_loss.item()
-                    batch_loss += loss
+                # The sub-batches have the same size, so these means are the means of the sub-batch values
 
-                    # Update memories for next epoch
-
-                    if i < self.recurrence - 1:
-                        exps.memory[inds + i + 1] = memory.detach()
+                batch_loss = policy_loss - self.entropy_coef * entropy + self.value_loss_coef * value_loss
 
                 # Update batch values
 
-                batch_entropy /= self.recurrence
-                batch_value /= self.recurrence
-                batch_policy_loss /= self.recurrence
-                batch_value_loss /= self.recurrence
-                batch_loss /= self.recurrence
+                batch_entropy = entropy.item()
+                batch_value = value.mean().item()
+                batch_policy_loss = policy_loss.item()
+                batch_value_loss = value_loss.item()
 
                 # Update actor-critic
 
                 self.optimizer.zero_grad()
                 batch_loss.backward()
+                if self.distributed:
+                    all_reduce_gradients(self.acmodel.parameters())
                 grad_norm = sum(p.grad.data.norm(2) ** 2 for p in self.acmodel.parameters() if p.grad is not None) ** 0.5
                 torch.nn.utils.clip_grad_norm_(self.acmodel.parameters(), self.max_grad_norm)
                 self.optimizer.step()
@@ -144,6 +138,12 @@ class PPOAlgo(BaseAlgo):
                 log_grad_norms.append(grad_norm.item())
                 log_losses.append(batch_loss.item())
 
+        if self.distributed:
+            # The gradients are averaged, but the batch norm statistics are updated
+            # by every learner with its own experiences
+            with torch.no_grad():
+                all_reduce_buffers(self.acmodel)
+
         # Log some values
 
         logs["entropy"] = numpy.mean(log_entropies)
@@ -155,6 +155,24 @@ class PPOAlgo(BaseAlgo):
 
         return logs
 
+    def _get_batches(self, exps):
+        """Gathers the batches of an epoch once, as contiguous
+        num_batches x recurrence x (batch_size / recurrence) x ... experiences,
+        and gives them in the order of `self._get_batches_starting_indexes()`.
+        The last batch is gathered on its own if it is smaller.
+        """
+
+        batches_starting_indexes = self._get_batches_starting_indexes()
+        offsets = numpy.arange(self.recurrence)[None, :, None]
+
+        num_full_batches = sum(len(inds) == len(batches_starting_indexes[0]) for inds in batches_starting_indexes)
+        for group in (batches_starting_indexes[:num_full_batches], batches_starting_indexes[num_full_batches:]):
+            if not group:
+                continue
+            batches = exps[numpy.stack(group)[:, None, :] + offsets]
+            for k in range(len(group)):
+                yield batches[k]
+
     def _get_batches_starting_indexes(self):
         """Gives, for each batch, the indexes of the observations given to
         the model and the experiences used to compute the loss at first.
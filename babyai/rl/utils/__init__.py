@@ -1,2 +1,7 @@
 from babyai.rl.utils.dictlist import DictList
-from babyai.rl.utils.penv import ParallelEnv
+from babyai.rl.utils.tensor_batch import TensorBatch
+from babyai.rl.utils.instr_cache import InstrEmbeddingCache, get_unique_instr_embedding
+from babyai.rl.utils.penv import ParallelEnv, SharedObsBuffer, make_env
+from babyai.rl.utils.actors import ActorPool
+from babyai.rl.utils.reward_shaping import ScaledReward
+from babyai.rl.utils import distributed
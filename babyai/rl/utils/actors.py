@@ -0,0 +1,219 @@
+import copy
+from queue import Empty
+import numpy
+import torch
+import torch.multiprocessing
+import torch.nn.functional as F
+
+from babyai.rl.utils.penv import build_envs
+from babyai.rl.utils.reward_shaping import reshape_rewards
+from babyai.rl.utils.tensor_batch import TensorBatch
+
+
+def merge_obss(obss, merge, dim):
+    """Stacks or concatenates (`merge` being `torch.stack` or `torch.cat`)
+    preprocessed observations along `dim`, after zero padding the
+    observations of every key, e.g. the instructions, to the same shape."""
+    batch_ndim = obss[0].batch_ndim
+    merged = TensorBatch(batch_ndim=batch_ndim + (merge is torch.stack))
+    for key in obss[0].keys():
+        values = [obs[key] for obs in obss]
+        shape = [max(sizes) for sizes in zip(*(value.shape[batch_ndim:] for value in values))]
+        padded = []
+        for value in values:
+            padding = []
+            for size, max_size in zip(reversed(value.shape[batch_ndim:]), reversed(shape)):
+                padding += [0, max_size - size]
+            padded.append(F.pad(value, padding) if any(padding) else value)
+        merged[key] = merge(padded, dim)
+    return merged
+
+
+def run_actor(envs, model, version, lock, queue, preprocess_obss, reshape_reward, num_frames_per_proc,
+              update=None, seed=0):
+    """Runs the environments `envs` with the latest weights of the shared `model`,
+    and puts rollouts of `num_frames_per_proc` frames of every environment
+    in `queue`, one after the other. If `update` is given, every rollout waits
+    for it to be released, i.e. for new weights. The actions are sampled
+    with the torch random number generator seeded with `seed`."""
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    envs = build_envs(envs)
+    num_envs = len(envs)
+
+    with lock:
+        local_model = copy.deepcopy(model)
+        local_version = version.value
+
+    obs = [env.reset() for env in envs]
+    memory = torch.zeros(num_envs, model.memory_size)
+    mask = torch.ones(num_envs)
+    episode_return = torch.zeros(num_envs)
+    episode_reshaped_return = torch.zeros(num_envs)
+    episode_num_frames = torch.zeros(num_envs)
+
+    while True:
+        if update is not None:
+            update.acquire()
+        if version.value != local_version:
+            with lock:
+                local_model.load_state_dict(model.state_dict())
+                local_version = version.value
+
+        rollout = {key: [] for key in ("obs", "memory", "mask", "action", "value", "reward", "log_prob")}
+        log = {"return_per_episode": [], "reshaped_return_per_episode": [], "num_frames_per_episode": []}
+
+        for _ in range(num_frames_per_proc):
+            preprocessed_obs = preprocess_obss(obs)
+            with torch.no_grad():
+                model_results = local_model(preprocessed_obs, memory * mask.unsqueeze(1))
+            dist = model_results['dist']
+            action = dist.sample()
+
+            results = [env.step(action_) for env, action_ in zip(envs, action.numpy())]
+            next_obs = [env.reset() if done_ else obs_
+                        for env, (obs_, _, done_, _) in zip(envs, results)]
+            reward = [result[1] for result in results]
+            done = [result[2] for result in results]
+
+            rollout["obs"].append(preprocessed_obs)
+            rollout["memory"].append(memory)
+            rollout["mask"].append(mask)
+            rollout["action"].append(action.int())
+            rollout["value"].append(model_results['value'])
+            rollout["log_prob"].append(dist.log_prob(action))
+            if reshape_reward is not None:
+                rollout["reward"].append(reshape_rewards(reshape_reward, next_obs, action, reward, done))
+            else:
+                rollout["reward"].append(torch.tensor(reward, dtype=torch.float))
+
+            obs = next_obs
+            memory = model_results['memory']
+            mask = 1 - torch.tensor(done, dtype=torch.float)
+
+            # Update log values
+
+            episode_return += torch.tensor(reward, dtype=torch.float)
+            episode_reshaped_return += rollout["reward"][-1]
+            episode_num_frames += 1
+            done = torch.tensor(done, dtype=torch.bool)
+            log["return_per_episode"].extend(episode_return[done].tolist())
+            log["reshaped_return_per_episode"].extend(episode_reshaped_return[done].tolist())
+            log["num_frames_per_episode"].extend(episode_num_frames[done].tolist())
+            episode_return *= mask
+            episode_reshaped_return *= mask
+            episode_num_frames *= mask
+
+        obss = rollout.pop("obs")
+        rollout = {key: torch.stack(values) for key, values in rollout.items()}
+        rollout["obs"] = merge_obss(obss, torch.stack, 0)
+        rollout["next_obs"] = preprocess_obss(obs)
+        rollout["next_memory"] = memory
+        rollout["next_mask"] = mask
+        rollout["log"] = log
+        queue.put(rollout)
+
+
+class ActorPool:
+    """Actor processes that run the environments with a snapshot of the
+    model, on CPU, while the learner updates the model.
+
+    The environments are split between `num_actors` processes. Every actor
+    puts its rollouts, of `num_frames_per_proc` frames of each of its
+    environments, in its own queue of at most `max_queue_size` rollouts, so
+    the rollouts are at most about `max_queue_size` updates old. The weights
+    are sent to the actors through shared memory by `update_weights`.
+
+    If `synchronous` is true, the actors only start a rollout once they are
+    sent new weights, so every rollout is collected with the model as of the
+    last `update_weights`. The pool then just moves the inference of the
+    model, and the transfer of the observations, to the environment processes.
+
+    `envs` should contain environment factories, see `ParallelEnv`. If
+    `preprocess_obss` has a vocabulary, it is shared between the processes.
+    Actor `i` samples its actions with the random number generator seeded
+    with `seed + i`, `seed` being by default the initial seed of torch.
+    """
+
+    def __init__(self, envs, acmodel, preprocess_obss, num_frames_per_proc, num_actors,
+                 reshape_reward=None, max_queue_size=1, start_method=None, synchronous=False, seed=None):
+        assert 1 <= num_actors <= len(envs), "There should be between 1 and len(envs) actors."
+
+        self.num_envs = len(envs)
+        self.num_frames_per_proc = num_frames_per_proc
+
+        context = torch.multiprocessing.get_context(start_method)
+
+        self.model = copy.deepcopy(acmodel).cpu()
+        self.model.share_memory()
+        self.version = context.Value('l', 0)
+        self.lock = context.Lock()
+
+        vocab = getattr(preprocess_obss, 'vocab', None)
+        if vocab is not None and vocab.shared is None:
+            self.manager = context.Manager()
+            vocab.share(self.manager.dict(vocab.vocab), self.manager.Lock())
+
+        if seed is None:
+            seed = torch.initial_seed() % 2 ** 32
+
+        self.queues = []
+        self.updates = []
+        self.processes = []
+        for i, env_ids in enumerate(numpy.array_split(numpy.arange(self.num_envs), num_actors)):
+            queue = context.Queue(max_queue_size)
+            self.queues.append(queue)
+            update = context.Semaphore(0) if synchronous else None
+            self.updates.append(update)
+            p = context.Process(target=run_actor,
+                                args=([envs[env_id] for env_id in env_ids], self.model, self.version, self.lock,
+                                      queue, preprocess_obss, reshape_reward, num_frames_per_proc, update,
+                                      seed + i))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+    def update_weights(self, acmodel):
+        """Makes the actors use the current weights of `acmodel` for their next rollouts."""
+        with self.lock:
+            self.model.load_state_dict(acmodel.state_dict())
+            self.version.value += 1
+        for update in self.updates:
+            if update is not None:
+                update.release()
+
+    def get_rollout(self):
+        """Waits for the next rollout of every actor, and returns them concatenated
+        in a dict of (num_frames_per_proc, num_envs, ...) tensors (except for
+        the "next_" entries, which hold the observations, memories and masks
+        that follow the rollout, and "log"), the environments being in order.
+        Raises a `RuntimeError` if an actor exited, e.g. on an exception."""
+        rollouts = [self._get(i) for i in range(len(self.queues))]
+        rollout = {key: torch.cat([rollout_[key] for rollout_ in rollouts], dim=1)
+                   for key in ("memory", "mask", "action", "value", "reward", "log_prob")}
+        rollout["obs"] = merge_obss([rollout_["obs"] for rollout_ in rollouts], torch.cat, 1)
+        rollout["next_obs"] = merge_obss([rollout_["next_obs"] for rollout_ in rollouts], torch.cat, 0)
+        for key in ("next_memory", "next_mask"):
+            rollout[key] = torch.cat([rollout_[key] for rollout_ in rollouts])
+        rollout["log"] = {key: sum((rollout_["log"][key] for rollout_ in rollouts), [])
+                          for key in rollouts[0]["log"]}
+        return rollout
+
+    def _get(self, i, poll_interval=1.):
+        # Waits for the next rollout of actor `i`, checking that the actor is still running
+        while True:
+            try:
+                return self.queues[i].get(timeout=poll_interval)
+            except Empty:
+                if not self.processes[i].is_alive():
+                    raise RuntimeError("actor {} exited with code {}".format(i, self.processes[i].exitcode))
+
+    def close(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        self.processes = []
+
+    def __del__(self):
+        for p in self.processes:
+            p.terminate()
@@ -0,0 +1,154 @@
+"""Data-parallel training with `torch.distributed`.
+
+Every learner process runs its own slice of the environments and computes
+the gradients of its own experiences, which are then averaged between the
+learners. The gloo backend runs on CPU, over TCP, so the learners can be
+processes of one host or of several nodes.
+"""
+
+import time
+import uuid
+from urllib.parse import urlparse
+import numpy
+import torch
+import torch.distributed as dist
+
+
+# The per-episode logs of `BaseAlgo.collect_experiences`
+EPISODE_LOGS = ("return_per_episode", "reshaped_return_per_episode", "num_frames_per_episode")
+# The logs of `PPOAlgo.update_parameters` that are averaged over the learners
+MEAN_LOGS = ("entropy", "value", "policy_loss", "value_loss", "loss")
+
+
+def init_distributed(url, world_size, rank, backend="gloo"):
+    """Joins the process group of `world_size` learners, rendezvousing at `url`,
+    e.g. "tcp://10.0.0.1:23456", where learner 0 listens.
+
+    Returns
+    -------
+    store : torch.distributed.Store
+        the key-value store of the group, e.g. for `share_vocab`
+
+    """
+    url = urlparse(url)
+    store = dist.TCPStore(url.hostname, url.port, world_size, rank == 0)
+    dist.init_process_group(backend, store=store, rank=rank, world_size=world_size)
+    return store
+
+
+def broadcast_model(model, src=0):
+    """Gives every learner the parameters and buffers of `model` in learner `src`."""
+    with torch.no_grad():
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src)
+
+
+def all_reduce_gradients(parameters):
+    """Averages the gradients of `parameters` over the learners, with one
+    all-reduce of a flat buffer. The parameters that have a gradient must be
+    the same in every learner, as they are for the same model and loss."""
+    parameters = [param for param in parameters if param.grad is not None]
+    flat_grad = torch.cat([param.grad.reshape(-1) for param in parameters])
+    dist.all_reduce(flat_grad)
+    flat_grad /= dist.get_world_size()
+    offset = 0
+    for param in parameters:
+        param.grad.copy_(flat_grad[offset:offset + param.numel()].view_as(param.grad))
+        offset += param.numel()
+
+
+def all_reduce_buffers(model):
+    """Averages the floating point buffers of `model`, e.g. the running statistics
+    of batch norm, over the learners, with one all-reduce of a flat buffer, and
+    gives every learner the other buffers, e.g. counters, of learner 0."""
+    buffers = [buffer for buffer in model.buffers() if buffer.is_floating_point()]
+    if buffers:
+        flat_buffer = torch.cat([buffer.reshape(-1) for buffer in buffers])
+        dist.all_reduce(flat_buffer)
+        flat_buffer /= dist.get_world_size()
+        offset = 0
+        for buffer in buffers:
+            buffer.copy_(flat_buffer[offset:offset + buffer.numel()].view_as(buffer))
+            offset += buffer.numel()
+    for buffer in model.buffers():
+        if not buffer.is_floating_point():
+            dist.broadcast(buffer, 0)
+
+
+def gather_logs(logs):
+    """Returns the logs of all the learners: the per-episode logs are concatenated
+    in rank order, the frame and episode counts summed and the losses averaged."""
+    all_logs = [None] * dist.get_world_size()
+    dist.all_gather_object(all_logs, logs)
+    logs = dict(logs)
+    for key in EPISODE_LOGS:
+        logs[key] = [value for logs_ in all_logs for value in logs_[key]]
+    for key in ("num_frames", "episodes_done"):
+        logs[key] = sum(logs_[key] for logs_ in all_logs)
+    for key in MEAN_LOGS:
+        if key in logs:
+            logs[key] = numpy.mean([logs_[key] for logs_ in all_logs])
+    return logs
+
+
+class StoreDict:
+    """The dict of a shared `Vocabulary`, kept in a `torch.distributed` store.
+
+    Only the operations of the vocabulary are supported. The keys are also
+    indexed by insertion order, since a store cannot list its keys.
+    """
+
+    def __init__(self, store, prefix):
+        self.store = store
+        self.prefix = prefix
+
+    def _key(self, key):
+        return "{}/key/{}".format(self.prefix, key)
+
+    def _index(self, index):
+        return "{}/index/{}".format(self.prefix, index)
+
+    def __contains__(self, key):
+        return self.store.check([self._key(key)])
+
+    def __getitem__(self, key):
+        return int(self.store.get(self._key(key)))
+
+    def __setitem__(self, key, value):
+        index = self.store.add(self.prefix + "/size", 1)
+        self.store.set(self._index(index), key)
+        self.store.set(self._key(key), str(value))
+
+    def __len__(self):
+        return self.store.add(self.prefix + "/size", 0)
+
+    def copy(self):
+        keys = [self.store.get(self._index(index)).decode() for index in range(1, len(self) + 1)]
+        return {key: self[key] for key in keys}
+
+
+class StoreLock:
+    """A lock between the processes that use a `torch.distributed` store."""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __enter__(self):
+        owner = uuid.uuid4().hex
+        while self.store.compare_set(self.name, "", owner).decode() != owner:
+            time.sleep(0.001)
+
+    def __exit__(self, *args):
+        self.store.delete_key(self.name)
+
+
+def share_vocab(vocab, store, rank, prefix="vocab"):
+    """Makes the learners give the same id to a new token, by sharing
+    `vocab`, which should be the same `Vocabulary` in every learner, through `store`."""
+    shared = StoreDict(store, prefix)
+    if rank == 0:
+        for token, _ in sorted(vocab.vocab.items(), key=lambda item: item[1]):
+            shared[token] = vocab.vocab[token]
+    dist.barrier()
+    vocab.share(shared, StoreLock(store, prefix + "/lock"))
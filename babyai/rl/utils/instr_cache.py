@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import numpy
+import torch
+import torch.nn.functional as F
+
+
+# The modules of an `ACModel` that compute the instruction embedding
+LANGUAGE_MODULES = ('word_embedding', 'instr_rnn', 'instr_convs')
+
+
+def get_unique_instr_embedding(model, instr):
+    """Returns `model._get_instr_embedding(instr)`, but runs the language model
+    only once per distinct instruction of the batch. The gradient flows back
+    to the language model as usual."""
+    unique_instr, inverse = torch.unique(instr, dim=0, return_inverse=True)
+    instr_embedding = model._get_instr_embedding(unique_instr)
+    if model.lang_model == 'attgru':
+        # The outputs are as long as the longest instruction, pad them
+        # to the width of `instr` as `ACModel.forward` expects
+        instr_embedding = F.pad(instr_embedding, (0, 0, 0, instr.shape[1] - instr_embedding.shape[1]))
+    return instr_embedding[inverse]
+
+
+class InstrEmbeddingCache:
+    """A least recently used cache of the instruction embeddings computed by
+    a model, keyed by token sequence.
+
+    The mission is constant within an episode, so collecting experiences
+    or evaluating a model mostly embeds instructions that were already
+    embedded. The cache is emptied whenever a parameter of the language model
+    is modified in place, e.g. by an optimizer step or `load_state_dict`.
+    The embeddings are computed without gradient.
+    """
+
+    def __init__(self, model, max_size=1000):
+        self.model = model
+        self.max_size = max_size
+        self.params = [param for name, param in model.named_parameters()
+                       if name.split('.')[0] in LANGUAGE_MODULES]
+        self.version = None
+        self.embeddings = OrderedDict()
+
+    def __call__(self, instr):
+        version = sum(param._version for param in self.params)
+        if version != self.version:
+            self.embeddings.clear()
+            self.version = version
+
+        keys = [tuple(row[row != 0]) for row in instr.cpu().numpy()]
+        missing = [key for key in dict.fromkeys(keys) if key not in self.embeddings]
+        if missing:
+            missing_instr = numpy.zeros((len(missing), max(len(key) for key in missing)))
+            for i, key in enumerate(missing):
+                missing_instr[i, :len(key)] = key
+            missing_instr = torch.tensor(missing_instr, device=instr.device, dtype=torch.long)
+            with torch.no_grad():
+                missing_embedding = self.model._get_instr_embedding(missing_instr)
+            for key, embedding in zip(missing, missing_embedding):
+                self.embeddings[key] = embedding[:len(key)] if self.model.lang_model == 'attgru' else embedding
+
+        embeddings = []
+        for key in keys:
+            self.embeddings.move_to_end(key)
+            embeddings.append(self.embeddings[key])
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+        if self.model.lang_model == 'attgru':
+            instr_embedding = embeddings[0].new_zeros(len(keys), instr.shape[1], embeddings[0].shape[-1])
+            for i, embedding in enumerate(embeddings):
+                instr_embedding[i, :len(embedding)] = embedding
+            return instr_embedding
+        return torch.stack(embeddings)
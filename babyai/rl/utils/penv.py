@@ -1,36 +1,265 @@
-from multiprocessing import Process, Pipe
+from collections import deque
+import copy
+import queue
+import sys
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from multiprocessing.sharedctypes import RawArray
+import numpy
 import gym
 
-def worker(conn, env):
-    while True:
-        cmd, data = conn.recv()
-        if cmd == "step":
-            obs, reward, done, info = env.step(data)
-            if done:
-                obs = env.reset()
-            conn.send((obs, reward, done, info))
-        elif cmd == "reset":
+from babyai.rl.utils.dictlist import DictList
+
+
+class SharedObsBuffer:
+    """Preallocated arrays, shared between processes, that hold the latest
+    image, direction, reward and done of every environment, and the values of
+    `num_aux_info` keys of its info dict. Environment `i` only ever writes
+    to slot `i`."""
+
+    def __init__(self, num_envs, observation_space, num_aux_info=0):
+        image_space = observation_space.spaces["image"]
+        self.specs = {
+            "image": ((num_envs,) + image_space.shape, image_space.dtype),
+            "direction": ((num_envs,), numpy.int64),
+            "reward": ((num_envs,), numpy.float64),
+            "done": ((num_envs,), numpy.bool_)
+        }
+        if num_aux_info > 0:
+            self.specs["aux_info"] = ((num_envs, num_aux_info), numpy.float64)
+        self.raw = {key: RawArray('b', int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+                    for key, (shape, dtype) in self.specs.items()}
+        self._make_views()
+
+    def _make_views(self):
+        for key, (shape, dtype) in self.specs.items():
+            setattr(self, key, numpy.frombuffer(self.raw[key], dtype=dtype).reshape(shape))
+
+    def __getstate__(self):
+        return {"specs": self.specs, "raw": self.raw}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def write(self, index, obs, reward=0., done=False, aux_info=None):
+        self.image[index] = obs["image"]
+        self.direction[index] = obs["direction"]
+        self.reward[index] = reward
+        self.done[index] = done
+        if aux_info is not None:
+            self.aux_info[index] = aux_info
+
+
+class PregeneratedEnv:
+    """Wraps an environment so that its next episodes are generated in advance,
+    by a background thread, on spare copies of the environment. `reset` swaps
+    in an already generated episode instead of generating one.
+
+    The spare copies share the random number generator of the wrapped
+    environment, so the sequence of episodes is the same as without the wrapper.
+    """
+
+    def __init__(self, env, num_episodes):
+        assert num_episodes >= 1
+        self.env = env
+        self.num_episodes = num_episodes
+        self.ready = None
+        self.free = None
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    def _start(self):
+        # The thread is started lazily, so that it runs in the worker process
+        self.ready = queue.Queue()
+        self.free = queue.Queue()
+        for _ in range(self.num_episodes):
+            spare = copy.deepcopy(self.env)
+            spare.unwrapped.np_random = self.env.unwrapped.np_random
+            self.free.put(spare)
+        thread = threading.Thread(target=self._generate)
+        thread.daemon = True
+        thread.start()
+
+    def _generate(self):
+        while True:
+            env = self.free.get()
+            obs = env.reset()
+            self.ready.put((env, obs))
+
+    def reset(self):
+        if self.ready is None:
+            self._start()
+        env, obs = self.ready.get()
+        self.free.put(self.env)
+        self.env = env
+        return obs
+
+    def step(self, action):
+        return self.env.step(action)
+
+
+def make_env(env_name, seed):
+    """Makes and seeds an environment. Use e.g. `functools.partial(make_env, name, seed)`
+    as a picklable environment factory for `ParallelEnv`."""
+    env = gym.make(env_name)
+    env.seed(seed)
+    return env
+
+
+def build_envs(envs, pregenerate=0):
+    """Calls the environment factories in `envs`, and wraps the environments
+    in `PregeneratedEnv` if `pregenerate` is positive."""
+    envs = [env() if callable(env) else env for env in envs]
+    if pregenerate > 0:
+        envs = [PregeneratedEnv(env, pregenerate) for env in envs]
+    return envs
+
+
+def batch_obss(obss):
+    """Stacks a list of observations into a `DictList` of arrays."""
+    return DictList({
+        "image": numpy.stack([obs["image"] for obs in obss]),
+        "direction": numpy.array([obs["direction"] for obs in obss]),
+        "mission": numpy.array([obs["mission"] for obs in obss], dtype=object)
+    })
+
+
+def step_block(envs, actions, buffer=None, start=0, offsets=None, aux_info=None):
+    if offsets is None:
+        offsets = range(len(envs))
+    results = []
+    for offset, action in zip(offsets, actions):
+        env = envs[offset]
+        index = start + offset
+        obs, reward, done, info = env.step(action)
+        if done:
             obs = env.reset()
-            conn.send(obs)
+        if aux_info is not None:
+            info = [info[key] for key in aux_info]
+        if buffer is None:
+            results.append((obs, reward, done, info))
+        elif aux_info is not None:
+            # Only the mission, when it changes, goes through the pipe
+            buffer.write(index, obs, reward, done, info)
+            results.append((None, obs["mission"] if done else None))
+        else:
+            # Only the info dict, and the mission when it changes, go through the pipe
+            buffer.write(index, obs, reward, done)
+            results.append((info, obs["mission"] if done else None))
+    return results
+
+
+def reset_block(envs, buffer=None, start=0):
+    results = []
+    for index, env in enumerate(envs, start):
+        obs = env.reset()
+        if buffer is None:
+            results.append(obs)
         else:
-            raise NotImplementedError
+            buffer.write(index, obs)
+            results.append(obs["mission"])
+    return results
+
+
+def worker(conn, envs, buffer=None, start=0, pregenerate=0, aux_info=None):
+    envs = build_envs(envs, pregenerate)
+    switch_interval = sys.getswitchinterval()
+    if pregenerate > 0:
+        # Switch threads often, so that a step never waits long for the generating threads.
+        # This is only done in the workers, as it affects every thread of the process.
+        sys.setswitchinterval(1e-4)
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == "step":
+                offsets, actions = data
+                conn.send(step_block(envs, actions, buffer, start, offsets, aux_info))
+            elif cmd == "reset":
+                conn.send(reset_block(envs, buffer, start))
+            elif cmd == "close":
+                conn.close()
+                break
+            else:
+                raise NotImplementedError
+    finally:
+        sys.setswitchinterval(switch_interval)
+
 
 class ParallelEnv(gym.Env):
-    """A concurrent execution of environments in multiple processes."""
+    """A concurrent execution of environments in multiple processes.
+
+    The environments are split in blocks of `envs_per_proc` consecutive
+    environments. The first block is run in the main process, every other
+    block is stepped in a loop by its own worker process.
+
+    If `shared_memory` is true, the workers write images, directions, rewards
+    and dones into a `SharedObsBuffer` instead of pickling them through the pipes.
+
+    If `pregenerate` is positive, every environment keeps that many episodes
+    generated in advance (see `PregeneratedEnv`), so that the automatic reset
+    at the end of an episode does not wait for the level generation. The
+    workers then switch threads more often; the main process is left as is.
+
+    Besides the synchronous `step`, the environments can be stepped
+    asynchronously with `send` and `recv`, which return the results of the
+    environments that are ready first, together with their ids.
+
+    `envs` can contain environment factories (e.g. `make_env` partials)
+    instead of environments, in which case every environment is constructed
+    in the process that runs it. Together with the "forkserver" or "spawn"
+    `start_method`, this keeps the workers from inheriting the memory
+    of the main process.
 
-    def __init__(self, envs):
+    If `batched_obs` is true, the observations are returned as one `DictList`
+    holding the stacked images, the directions and the missions of all the
+    environments, instead of a list of observation dicts.
+
+    If `aux_info` is given, the infos of a step are an (N, K) array of the
+    values of these K keys of the info dicts of the N environments, instead
+    of the info dicts, e.g. for `ExtraInfoCollector`. With `shared_memory`,
+    they are written in the `SharedObsBuffer` too.
+    """
+
+    def __init__(self, envs, shared_memory=False, envs_per_proc=1, pregenerate=0, start_method=None,
+                 batched_obs=False, aux_info=None):
         assert len(envs) >= 1, "No environment given."
 
         self.envs = envs
-        self.observation_space = self.envs[0].observation_space
-        self.action_space = self.envs[0].action_space
+        self.num_envs = len(envs)
+        self.shared_memory = shared_memory
+        self.envs_per_proc = envs_per_proc
+        self.batched_obs = batched_obs
+        self.aux_info = list(aux_info) if aux_info else None
+
+        self.starts = list(range(0, self.num_envs, self.envs_per_proc))
+        self.blocks = [self.envs[start:start + self.envs_per_proc] for start in self.starts]
+        self.blocks[0] = build_envs(self.blocks[0], pregenerate)
+
+        self.observation_space = self.blocks[0][0].observation_space
+        self.action_space = self.blocks[0][0].action_space
 
+        self.buffer = None
+        if self.shared_memory:
+            self.buffer = SharedObsBuffer(self.num_envs, self.observation_space,
+                                          len(self.aux_info) if self.aux_info else 0)
+            self.missions = [None] * self.num_envs
+
+        # Ids of the environments each worker is currently stepping for `recv`,
+        # and the results of the main process' block that are not received yet
+        self.pending = {}
+        self.ready = []
+
+        context = multiprocessing.get_context(start_method)
         self.locals = []
         self.processes = []
-        for env in self.envs[1:]:
-            local, remote = Pipe()
+        for start, block in zip(self.starts[1:], self.blocks[1:]):
+            local, remote = context.Pipe()
             self.locals.append(local)
-            p = Process(target=worker, args=(remote, env))
+            p = context.Process(target=worker, args=(remote, block, self.buffer, start, pregenerate,
+                                                     self.aux_info))
             p.daemon = True
             p.start()
             remote.close()
@@ -39,21 +268,129 @@ class ParallelEnv(gym.Env):
     def reset(self):
         for local in self.locals:
             local.send(("reset", None))
-        results = [self.envs[0].reset()] + [local.recv() for local in self.locals]
+        results = reset_block(self.blocks[0], self.buffer)
+        for local in self.locals:
+            results.extend(local.recv())
+        if self.shared_memory:
+            self.missions = results
+            return self._read_obss()
+        if self.batched_obs:
+            return batch_obss(results)
         return results
 
     def step(self, actions):
-        for local, action in zip(self.locals, actions[1:]):
-            local.send(("step", action))
-        obs, reward, done, info = self.envs[0].step(actions[0])
-        if done:
-            obs = self.envs[0].reset()
-        results = zip(*[(obs, reward, done, info)] + [local.recv() for local in self.locals])
-        return results
+        for local, start, block in zip(self.locals, self.starts[1:], self.blocks[1:]):
+            local.send(("step", (None, actions[start:start + len(block)])))
+        results = step_block(self.blocks[0], actions, self.buffer, aux_info=self.aux_info)
+        for local in self.locals:
+            results.extend(local.recv())
+        if self.shared_memory:
+            return self._read_results(range(self.num_envs), results)
+        obs, reward, done, info = zip(*results)
+        if self.batched_obs:
+            obs = batch_obss(obs)
+        if self.aux_info:
+            info = numpy.array(info, dtype=numpy.float64)
+        return obs, reward, done, info
+
+    def send(self, actions, env_ids):
+        """Starts stepping the environments `env_ids` with `actions`,
+        without waiting for the results. The results are obtained with `recv`."""
+        requests = {}
+        for env_id, action in zip(env_ids, actions):
+            block = env_id // self.envs_per_proc
+            offsets, block_actions = requests.setdefault(block, ([], []))
+            offsets.append(env_id - self.starts[block])
+            block_actions.append(action)
+        for block, (offsets, block_actions) in requests.items():
+            if block == 0:
+                continue
+            local = self.locals[block - 1]
+            local.send(("step", (offsets, block_actions)))
+            self.pending.setdefault(local, deque()).append(
+                [self.starts[block] + offset for offset in offsets])
+        if 0 in requests:
+            offsets, block_actions = requests[0]
+            self.ready.append((offsets, step_block(self.blocks[0], block_actions, self.buffer, 0, offsets,
+                                                   self.aux_info)))
+
+    def recv(self, min_ready=1):
+        """Waits until at least `min_ready` of the environments given to `send`
+        have been stepped (or until none is pending), and returns the results of
+        all the environments that are ready.
+
+        Returns
+        -------
+        obs, reward, done, info
+            the results for the ready environments, as for `step`
+        env_ids : list of int
+            the ids of the environments these results belong to
+
+        """
+        env_ids, results = [], []
+        for ids, block_results in self.ready:
+            env_ids.extend(ids)
+            results.extend(block_results)
+        self.ready = []
+        timeout = None
+        while self.pending:
+            if len(env_ids) >= min_ready:
+                # Also take the environments that are already done, without blocking
+                timeout = 0
+            conns = wait(list(self.pending), timeout)
+            if not conns:
+                break
+            for local in conns:
+                env_ids.extend(self.pending[local].popleft())
+                if not self.pending[local]:
+                    del self.pending[local]
+                results.extend(local.recv())
+        if self.shared_memory:
+            return (*self._read_results(env_ids, results), env_ids)
+        obs, reward, done, info = zip(*results) if results else ((), (), (), ())
+        if self.batched_obs and obs:
+            obs = batch_obss(obs)
+        if self.aux_info:
+            info = numpy.array(info, dtype=numpy.float64).reshape(len(env_ids), len(self.aux_info))
+        return obs, reward, done, info, env_ids
+
+    def _read_results(self, env_ids, results):
+        infos = []
+        for env_id, (info, mission) in zip(env_ids, results):
+            if mission is not None:
+                self.missions[env_id] = mission
+            infos.append(info)
+        env_ids = list(env_ids)
+        infos = self.buffer.aux_info[env_ids] if self.aux_info else tuple(infos)
+        return (self._read_obss(env_ids), self.buffer.reward[env_ids],
+                self.buffer.done[env_ids], infos)
+
+    def _read_obss(self, env_ids=None):
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        # One copy of the images, so that the returned observations
+        # are not overwritten by the next step
+        images = self.buffer.image[list(env_ids)]
+        if self.batched_obs:
+            return DictList({
+                "image": images,
+                "direction": self.buffer.direction[list(env_ids)],
+                "mission": numpy.array([self.missions[env_id] for env_id in env_ids], dtype=object)
+            })
+        return [{"image": images[i], "direction": self.buffer.direction[env_id], "mission": self.missions[env_id]}
+                for i, env_id in enumerate(env_ids)]
+
+    def close(self):
+        for local in self.locals:
+            local.send(("close", None))
+        for p in self.processes:
+            p.join()
+        self.locals = []
+        self.processes = []
 
     def render(self):
         raise NotImplementedError
 
     def __del__(self):
         for p in self.processes:
-            p.terminate()
\ No newline at end of file
+            p.terminate()
@@ -0,0 +1,79 @@
+"""Advantages and returns of a whole (T, P) block of experiences.
+
+In all the functions below, T is the number of frames per process and P
+the number of processes. `rewards`, `values` and `next_masks` are (T, P)
+tensors, where `next_masks[t]` is 0 if the episode ended at frame `t` and
+1 otherwise. `next_value` is the (P,) value of the observations that follow
+the block, i.e. the bootstrap value.
+"""
+
+import torch
+
+
+def discounted_cumsum(x, discounts):
+    """Computes `y[t] = x[t] + discounts[t] * y[t + 1]` backwards in time,
+    with `y[T] = 0`, for (T, P) tensors `x` and `discounts`."""
+    y = torch.zeros_like(x)
+    next_y = torch.zeros_like(x[0])
+    for t in range(x.shape[0] - 1, -1, -1):
+        next_y = x[t] + discounts[t] * next_y
+        y[t] = next_y
+    return y
+
+
+def get_next_values(values, next_value):
+    """Returns the (T, P) values of the frames that follow every frame."""
+    return torch.cat((values[1:], next_value.unsqueeze(0)))
+
+
+def compute_gae(rewards, values, next_masks, next_value, discount, gae_lambda):
+    """Returns the generalized advantage estimates
+    ([Schulman et al., 2015](https://arxiv.org/abs/1506.02438))."""
+    deltas = rewards + discount * get_next_values(values, next_value) * next_masks - values
+    return discounted_cumsum(deltas, discount * gae_lambda * next_masks)
+
+
+def compute_nstep_advantages(rewards, values, next_masks, next_value, discount, n_steps):
+    """Returns the n-step returns minus the values. A return is truncated at the
+    end of its episode, and bootstraps from `next_value` at the end of the block."""
+    T = rewards.shape[0]
+    returns = torch.zeros_like(rewards)
+    discounts = torch.ones_like(rewards)
+    for k in range(n_steps):
+        # The frames t for which t + k is still in the block
+        valid = torch.arange(T, device=rewards.device) < T - k
+        shifted_rewards = torch.zeros_like(rewards)
+        shifted_rewards[:T - k] = rewards[k:]
+        shifted_masks = torch.ones_like(next_masks)
+        shifted_masks[:T - k] = next_masks[k:]
+        returns += discounts * shifted_rewards
+        discounts *= torch.where(valid.unsqueeze(1), discount * shifted_masks, torch.ones_like(shifted_masks))
+    bootstrap_indexes = torch.clamp(torch.arange(T, device=rewards.device) + n_steps, max=T)
+    bootstrap_values = torch.cat((values, next_value.unsqueeze(0)))[bootstrap_indexes]
+    return returns + discounts * bootstrap_values - values
+
+
+def compute_vtrace(rewards, values, next_masks, next_value, log_rhos, discount,
+                   rho_bar=1., c_bar=1.):
+    """Returns the V-trace targets and policy gradient advantages
+    ([Espeholt et al., 2018](https://arxiv.org/abs/1802.01561)) of experiences
+    collected by a behaviour policy, where `log_rhos` is the (T, P) log ratio
+    of the probabilities of the actions under the target and behaviour policies.
+
+    Returns
+    -------
+    vs : torch.Tensor
+        the V-trace targets of the values
+    advantages : torch.Tensor
+        the advantages for the policy gradient
+
+    """
+    rhos = torch.exp(log_rhos)
+    clipped_rhos = torch.clamp(rhos, max=rho_bar)
+    cs = torch.clamp(rhos, max=c_bar)
+    next_values = get_next_values(values, next_value)
+    deltas = clipped_rhos * (rewards + discount * next_values * next_masks - values)
+    vs = values + discounted_cumsum(deltas, discount * cs * next_masks)
+    next_vs = get_next_values(vs, next_value)
+    advantages = clipped_rhos * (rewards + discount * next_vs * next_masks - values)
+    return vs, advantages
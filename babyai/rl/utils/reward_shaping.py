@@ -0,0 +1,37 @@
+import torch
+
+
+class ScaledReward:
+    """Multiplies the rewards by `scale`.
+
+    A reward shaper is a function of (observation, action, reward, done). It can
+    also have a `batch` method, that takes the observations, actions, rewards and
+    dones of a batch of transitions at once, the last three as tensors of the
+    same shape, e.g. (P,) for a step or (T, P) for a whole rollout, and returns
+    the shaped rewards as a tensor of that shape. Unlike a lambda, an instance
+    of this class can be sent to processes started with "spawn" or "forkserver".
+    """
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, obs, action, reward, done):
+        return self.scale * reward
+
+    def batch(self, obss, actions, rewards, dones):
+        return self.scale * rewards
+
+
+def reshape_rewards(reshape_reward, obss, actions, rewards, dones, device=None):
+    """Returns the rewards of a batch of transitions, shaped by `reshape_reward`,
+    as a float tensor. Uses `reshape_reward.batch` if there is one, otherwise
+    calls `reshape_reward` on every transition."""
+    if hasattr(reshape_reward, "batch"):
+        # The rewards are shaped in double precision, as by a per-transition function
+        rewards = torch.tensor(rewards, device=device, dtype=torch.float64)
+        dones = torch.tensor(dones, device=device, dtype=torch.bool)
+        return reshape_reward.batch(obss, actions, rewards, dones).float()
+    return torch.tensor([
+        reshape_reward(obss[j], actions[j], rewards[j], dones[j])
+        for j in range(len(rewards))
+    ], device=device, dtype=torch.float)
@@ -2,7 +2,7 @@ import torch
 
 import torch.nn.functional as F
 import numpy
-from babyai.rl.utils import DictList
+from babyai.rl.utils import TensorBatch
 
 # dictionary that defines what head is required for each extra info used for auxiliary supervision
 required_heads = {'seen_state': 'binary',
@@ -18,17 +18,17 @@ class ExtraInfoCollector:
     '''
     This class, used in rl.algos.base, allows connecting the extra information from the environment, and the
     corresponding predictions using the specific heads in the model. It transforms them so that they are easy to use
-    to evaluate losses
+    to evaluate losses. The extra information of all the keys is collected in a single K x T x P tensor, where K is
+    the number of keys
     '''
     def __init__(self, aux_info, shape, device):
         self.aux_info = aux_info
         self.shape = shape
         self.device = device
 
-        self.collected_info = dict()
+        self.collected_info = torch.zeros(len(self.aux_info), *shape, device=self.device)
         self.extra_predictions = dict()
         for info in self.aux_info:
-            self.collected_info[info] = torch.zeros(*shape, device=self.device)
             if required_heads[info] == 'binary' or required_heads[info].startswith('continuous'):
                 # we predict one number only
                 self.extra_predictions[info] = torch.zeros(*shape, 1, device=self.device)
@@ -40,34 +40,34 @@ class ExtraInfoCollector:
                 raise ValueError("{} not supported".format(required_heads[info]))
 
     def process(self, env_info):
-        # env_info is now a tuple of dicts
-        env_info = [{k: v for k, v in dic.items() if k in self.aux_info} for dic in env_info]
-        env_info = {k: [env_info[_][k] for _ in range(len(env_info))] for k in env_info[0].keys()}
-        # env_info is now a dict of lists
-        return env_info
+        # env_info is either a tuple of dicts, or already a P x K array when the ParallelEnv is given aux_info
+        if not isinstance(env_info, numpy.ndarray):
+            env_info = numpy.array([[dic[info] for info in self.aux_info] for dic in env_info], dtype=numpy.float64)
+        # env_info is now a K x P tensor
+        return torch.tensor(env_info.T, dtype=torch.float, device=self.device)
 
     def fill_dictionaries(self, index, env_info, extra_predictions):
+        self.collected_info[:, index] = env_info
         for info in self.aux_info:
-            dtype = torch.long if required_heads[info].startswith('multiclass') else torch.float
-            self.collected_info[info][index] = torch.tensor(env_info[info], dtype=dtype, device=self.device)
             self.extra_predictions[info][index] = extra_predictions[info]
 
     def end_collection(self, exps):
         collected_info = dict()
         extra_predictions = dict()
-        for info in self.aux_info:
-            # T x P -> P x T -> P * T
-            collected_info[info] = self.collected_info[info].transpose(0, 1).reshape(-1)
+        # K x T x P -> K x P x T -> K x (P * T)
+        all_collected_info = self.collected_info.transpose(1, 2).reshape(len(self.aux_info), -1)
+        for pos, info in enumerate(self.aux_info):
+            collected_info[info] = all_collected_info[pos]
             if required_heads[info] == 'binary' or required_heads[info].startswith('continuous'):
                 # T x P x 1 -> P x T x 1 -> P * T
                 extra_predictions[info] = self.extra_predictions[info].transpose(0, 1).reshape(-1)
-            elif type(required_heads[info]) == int:
+            elif required_heads[info].startswith('multiclass'):
                 # T x P x k -> P x T x k -> (P * T) x k
-                k = required_heads[info]  # number of classes
+                k = self.extra_predictions[info].shape[-1]  # number of classes
                 extra_predictions[info] = self.extra_predictions[info].transpose(0, 1).reshape(-1, k)
-        # convert the dicts to DictLists, and add them to the exps DictList.
-        exps.collected_info = DictList(collected_info)
-        exps.extra_predictions = DictList(extra_predictions)
+        # convert the dicts to TensorBatches, and add them to the exps TensorBatch.
+        exps.collected_info = TensorBatch(collected_info)
+        exps.extra_predictions = TensorBatch(extra_predictions)
 
         return exps
 
@@ -118,7 +118,7 @@ class SupervisedLossUpdater:
         for pos, info in enumerate(self.aux_info):
             coef = self.supervised_loss_coef[pos]
             pred = extra_predictions[info]
-            target = dict.__getitem__(sb.collected_info, info)
+            target = sb.collected_info[info]
             if required_heads[info] == 'binary':
                 binary_classification_tasks += 1
                 classification_tasks += 1
@@ -0,0 +1,118 @@
+import torch
+
+
+class TensorBatch:
+    """A batch of named tensors, or nested `TensorBatch`es, that share their
+    first `batch_ndim` dimensions. Tensors are accessed using `.` notation
+    or `[name]`, and indexing with anything else indexes every tensor,
+    which gives views for integers and slices.
+
+    Unlike `DictList`, it knows its batch shape, can be moved to a device
+    or pinned, and can be allocated once and then filled in place.
+
+    Example:
+        >>> batch = TensorBatch({"a": torch.zeros(4, 3), "b": torch.zeros(4)})
+        >>> batch.shape
+        torch.Size([4])
+        >>> batch[1:3].a.shape
+        torch.Size([2, 3])
+    """
+
+    __slots__ = ("_tensors", "batch_ndim")
+
+    def __init__(self, tensors=None, batch_ndim=1):
+        object.__setattr__(self, "_tensors", dict(tensors or {}))
+        object.__setattr__(self, "batch_ndim", batch_ndim)
+
+    @classmethod
+    def zeros(cls, batch_shape, specs, device=None, pin_memory=False):
+        """Allocates a batch of zeros, where `specs` maps every name to
+        the (shape, dtype) of one element of the batch."""
+        return cls({key: torch.zeros(*batch_shape, *shape, dtype=dtype, device=device, pin_memory=pin_memory)
+                    for key, (shape, dtype) in specs.items()}, len(batch_shape))
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            # e.g. `_tensors` itself, when copying before `__init__` is called
+            raise AttributeError(key)
+        try:
+            return self._tensors[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self._tensors[key] = value
+
+    def __getstate__(self):
+        return self._tensors, self.batch_ndim
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __contains__(self, key):
+        return key in self._tensors
+
+    def keys(self):
+        return self._tensors.keys()
+
+    def values(self):
+        return self._tensors.values()
+
+    def items(self):
+        return self._tensors.items()
+
+    def get(self, key, default=None):
+        return self._tensors.get(key, default)
+
+    def _first(self):
+        return first_tensor(self._tensors)
+
+    @property
+    def shape(self):
+        return self._first().shape[:self.batch_ndim]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self._tensors[index]
+        tensors = {key: value[index] for key, value in self._tensors.items()}
+        # The index removes batch dimensions, or adds some if it is a multi-dimensional array
+        batch_ndim = self.batch_ndim - self._first().dim() + first_tensor(tensors).dim()
+        return TensorBatch(tensors, batch_ndim)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, str):
+            self._tensors[index] = value
+        else:
+            for key, tensor in value.items():
+                self._tensors[key][index] = tensor
+
+    def _apply(self, fn, batch_ndim=None):
+        batch_ndim = self.batch_ndim if batch_ndim is None else batch_ndim
+        return TensorBatch({key: value._apply(fn, batch_ndim) if isinstance(value, TensorBatch) else fn(value)
+                            for key, value in self._tensors.items()}, batch_ndim)
+
+    def to(self, *args, **kwargs):
+        return self._apply(lambda tensor: tensor.to(*args, **kwargs))
+
+    def pin_memory(self):
+        return self._apply(lambda tensor: tensor.pin_memory())
+
+    def reshape(self, *batch_shape):
+        """Reshapes the batch dimensions."""
+        return self._apply(lambda tensor: tensor.reshape(*batch_shape, *tensor.shape[self.batch_ndim:]),
+                           len(batch_shape))
+
+    def transpose(self, dim0, dim1):
+        """Swaps two batch dimensions."""
+        return self._apply(lambda tensor: tensor.transpose(dim0, dim1))
+
+    def __repr__(self):
+        return "TensorBatch({})".format(self._tensors)
+
+
+def first_tensor(tensors):
+    value = next(iter(tensors.values()))
+    return value._first() if isinstance(value, TensorBatch) else value
@@ -4,7 +4,7 @@ import numpy
 import torch
 from babyai.utils.agent import load_agent, ModelAgent, DemoAgent, BotAgent
 from babyai.utils.demos import (
-    load_demos, save_demos, synthesize_demos, get_demos_path)
+    load_demos, save_demos, synthesize_demos, get_demos_path, generate_demo, generate_demos)
 from babyai.utils.format import ObssPreprocessor, IntObssPreprocessor, get_vocab_path
 from babyai.utils.log import (
     get_log_path, get_log_dir, synthesize, configure_logging)
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
+import numpy
 import torch
 from .. import utils
 from babyai.bot import Bot
 from babyai.model import ACModel
+from babyai.rl.utils import InstrEmbeddingCache
 from random import Random
 
 
@@ -47,8 +49,11 @@ class ModelAgent(Agent):
         self.device = next(self.model.parameters()).device
         self.argmax = argmax
         self.memory = None
+        self.instr_cache = None
 
     def act_batch(self, many_obs):
+        """Proposes actions for a list of observations, or for a batch of
+        observations as returned by `ParallelEnv` with `batched_obs`."""
         if self.memory is None:
             self.memory = torch.zeros(
                 len(many_obs), self.model.memory_size, device=self.device)
@@ -56,8 +61,15 @@ class ModelAgent(Agent):
             raise ValueError("stick to one batch size for the lifetime of an agent")
         preprocessed_obs = self.obss_preprocessor(many_obs, device=self.device)
 
+        instr_embedding = None
+        if self.model.use_instr:
+            # The model can be swapped, e.g. for the model being trained
+            if self.instr_cache is None or self.instr_cache.model is not self.model:
+                self.instr_cache = InstrEmbeddingCache(self.model)
+            instr_embedding = self.instr_cache(preprocessed_obs.instr)
+
         with torch.no_grad():
-            model_results = self.model(preprocessed_obs, self.memory)
+            model_results = self.model(preprocessed_obs, self.memory, instr_embedding)
             dist = model_results['dist']
             value = model_results['value']
             self.memory = model_results['memory']
@@ -75,7 +87,7 @@ class ModelAgent(Agent):
         return self.act_batch([obs])
 
     def analyze_feedback(self, reward, done):
-        if isinstance(done, tuple):
+        if isinstance(done, (tuple, numpy.ndarray)):
             for i in range(len(done)):
                 if done[i]:
                     self.memory[i, :] *= 0.
@@ -1,10 +1,20 @@
+import functools
+import logging
+import multiprocessing
 import os
 import pickle
+import time
+import gym
+import numpy
+import torch
 
 from .. import utils
 import blosc
 
 
+logger = logging.getLogger(__name__)
+
+
 def get_demos_path(demos=None, env=None, origin=None, valid=False):
     valid_suff = '_valid' if valid else ''
     demos_path = (demos + valid_suff
@@ -28,6 +38,159 @@ def save_demos(demos, path):
     pickle.dump(demos, open(path, "wb"))
 
 
+# The environment and agent of a process that generates demos
+_generator = None
+
+
+def _init_generator(env_name, model, argmax):
+    global _generator
+    env = gym.make(env_name)
+    _generator = env, utils.load_agent(env, model, argmax=argmax, env_name=env_name)
+
+
+def _init_worker(env_name, model, argmax):
+    # The processes of the pool share the cores
+    torch.set_num_threads(1)
+    _init_generator(env_name, model, argmax)
+
+
+def generate_demo(env, agent, seed, filter_steps=0, on_exception='warn', replace_failures=True):
+    """
+    Returns the demo of `agent` on the episode of `env` seeded with `seed`,
+    as a tuple (mission, blosc.pack_array(np.array(images)), directions, actions).
+
+    If the agent fails, or takes more than `filter_steps` steps (if not 0), the
+    demo is of the next episode of `env` it succeeds on when `replace_failures`
+    is true, and None otherwise. If `on_exception` is 'crash', failures raise instead.
+    """
+    if not isinstance(agent, utils.BotAgent):
+        # The agent may sample its actions
+        utils.seed(seed)
+    env.seed(seed)
+
+    while True:
+        obs = env.reset()
+        agent.on_reset()
+
+        actions = []
+        mission = obs["mission"]
+        images = []
+        directions = []
+
+        try:
+            done = False
+            while not done:
+                action = agent.act(obs)['action']
+                if isinstance(action, torch.Tensor):
+                    action = action.item()
+                new_obs, reward, done, _ = env.step(action)
+                agent.analyze_feedback(reward, done)
+
+                actions.append(action)
+                images.append(obs['image'])
+                directions.append(obs['direction'])
+
+                obs = new_obs
+            if reward > 0 and (filter_steps == 0 or len(images) <= filter_steps):
+                return (mission, blosc.pack_array(numpy.array(images)), directions, actions)
+
+            if reward == 0:
+                if on_exception == 'crash':
+                    raise Exception("mission failed, the seed is {}".format(seed))
+                logger.info("mission failed, the seed is {}".format(seed))
+        except (Exception, AssertionError):
+            if on_exception == 'crash':
+                raise
+            logger.exception("error while generating the demo of seed {}".format(seed))
+
+        if not replace_failures:
+            return None
+        logger.info("reset the environment to find a mission that the agent can solve")
+
+
+def _generate_shard(shard, **kwargs):
+    seeds, shard_path, params = shard
+    if shard_path is not None and os.path.exists(shard_path):
+        saved = load_demos(shard_path)
+        if isinstance(saved, dict) and saved.get('params') == params:
+            logger.info("resuming from the demos saved at {}".format(shard_path))
+            return saved['demos']
+        logger.warning("the demos saved at {} were generated with other arguments, "
+                       "generating them again".format(shard_path))
+
+    env, agent = _generator
+    demos = [generate_demo(env, agent, int(seed), **kwargs) for seed in seeds]
+    demos = [demo for demo in demos if demo is not None]
+
+    if shard_path is not None:
+        # Written in one go, so that an existing shard is always complete
+        save_demos({'params': params, 'demos': demos}, shard_path + '.tmp')
+        os.replace(shard_path + '.tmp', shard_path)
+    return demos
+
+
+def generate_demos(env_name, seeds, model='BOT', argmax=True, filter_steps=0, on_exception='warn',
+                   replace_failures=True, procs=1, shard_size=100, shards_path=None, log_interval=100):
+    """
+    Returns the demos of the agent `model` (see `load_agent`) on the episodes
+    of `env_name` seeded with `seeds`, in the order of the seeds.
+    See `generate_demo` for the other arguments.
+
+    The seeds are split in shards of `shard_size` seeds, that `procs` processes
+    generate in parallel. The demo of a seed only depends on the seed, so the
+    demos do not depend on `procs` nor on `shard_size`. If `shards_path` is
+    given, every shard is saved there as soon as it is generated, together
+    with the arguments it was generated with, and a shard that is already
+    saved with the same arguments is loaded instead, so that an interrupted
+    generation can be resumed. The shards are removed once all the demos are
+    generated.
+    """
+    seeds = list(seeds)
+    shards = []
+    for i in range(0, len(seeds), shard_size):
+        shard_seeds = seeds[i:i + shard_size]
+        shard_path = (None if shards_path is None
+                      else '{}.shard{}-{}'.format(shards_path, shard_seeds[0], shard_seeds[-1]))
+        # Everything the demos of the shard depend on
+        params = {'env': env_name, 'seeds': [int(seed) for seed in shard_seeds], 'model': model,
+                  'argmax': argmax, 'filter_steps': filter_steps, 'replace_failures': replace_failures}
+        shards.append((shard_seeds, shard_path, params))
+
+    generate_shard = functools.partial(_generate_shard, filter_steps=filter_steps,
+                                       on_exception=on_exception, replace_failures=replace_failures)
+    pool = None
+    if procs == 1:
+        _init_generator(env_name, model, argmax)
+        shard_demos = map(generate_shard, shards)
+    else:
+        pool = multiprocessing.Pool(procs, _init_worker, (env_name, model, argmax))
+        shard_demos = pool.imap(generate_shard, shards)
+
+    demos = []
+    checkpoint_time = time.time()
+    checkpoint_demos = 0
+    try:
+        for new_demos in shard_demos:
+            demos.extend(new_demos)
+            if len(demos) - checkpoint_demos >= log_interval:
+                now = time.time()
+                demos_per_second = (len(demos) - checkpoint_demos) / (now - checkpoint_time)
+                to_go = (len(seeds) - len(demos)) / demos_per_second
+                logger.info("demo #{}, {:.3f} demos per second, {:.3f} seconds to go".format(
+                    len(demos) - 1, demos_per_second, to_go))
+                checkpoint_time = now
+                checkpoint_demos = len(demos)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if shards_path is not None:
+        for _, shard_path, _ in shards:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+    return demos
+
+
 def synthesize_demos(demos):
     print('{} demonstrations saved'.format(len(demos)))
     num_frames_per_episode = [len(demo[2]) for demo in demos]
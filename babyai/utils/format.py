@@ -1,5 +1,6 @@
 import os
 import json
+from collections import OrderedDict
 import numpy
 import re
 import torch
@@ -20,9 +21,29 @@ class Vocabulary:
             self.vocab = json.load(open(self.path))
         else:
             self.vocab = {}
+        self.shared = None
+        self.lock = None
+
+    def share(self, shared, lock):
+        '''
+        Makes the vocabulary shared between processes through `shared`, a dict
+        shared between them, e.g. by a `multiprocessing.Manager`, and `lock`,
+        so that all of them give the same id to a new token. The tokens already
+        seen are still looked up locally.
+        '''
+        self.shared = shared
+        self.lock = lock
 
     def __getitem__(self, token):
         if not (token in self.vocab.keys()):
+            if self.shared is not None:
+                with self.lock:
+                    if token not in self.shared:
+                        if len(self.shared) >= self.max_size:
+                            raise ValueError("Maximum vocabulary capacity reached")
+                        self.shared[token] = len(self.shared) + 1
+                    self.vocab[token] = self.shared[token]
+                return self.vocab[token]
             if len(self.vocab) >= self.max_size:
                 raise ValueError("Maximum vocabulary capacity reached")
             self.vocab[token] = len(self.vocab) + 1
@@ -31,6 +52,8 @@ class Vocabulary:
     def save(self, path=None):
         if path is None:
             path = self.path
+        if self.shared is not None:
+            self.vocab.update(self.shared.copy())
         utils.create_folders_if_necessary(path)
         json.dump(self.vocab, open(path, "w"))
 
@@ -41,10 +64,27 @@ class Vocabulary:
         self.vocab.update(other.vocab)
 
 
+def get_images(obss):
+    """Returns the images of a list of observations, or of a batch of
+    observations as returned by `ParallelEnv` with `batched_obs`, as one array."""
+    if isinstance(obss, dict):
+        return dict.__getitem__(obss, "image")
+    return numpy.array([obs["image"] for obs in obss])
+
+
+def get_missions(obss):
+    if isinstance(obss, dict):
+        return dict.__getitem__(obss, "mission")
+    return [obs["mission"] for obs in obss]
+
+
 class InstructionsPreprocessor(object):
-    def __init__(self, model_name, load_vocab_from=None):
+    def __init__(self, model_name, load_vocab_from=None, max_cache_size=10000):
         self.model_name = model_name
         self.vocab = Vocabulary(model_name)
+        # The token ids of the recently seen missions, by mission
+        self.cache = OrderedDict()
+        self.max_cache_size = max_cache_size
 
         path = get_vocab_path(model_name)
         if not os.path.exists(path) and load_vocab_from is not None:
@@ -56,20 +96,25 @@ class InstructionsPreprocessor(object):
             else:
                 raise FileNotFoundError('No pre-trained model under the specified name')
 
-    def __call__(self, obss, device=None):
-        raw_instrs = []
-        max_instr_len = 0
+    def tokenize(self, mission):
+        instr = self.cache.get(mission)
+        if instr is None:
+            tokens = re.findall("([a-z]+)", mission.lower())
+            instr = numpy.array([self.vocab[token] for token in tokens], dtype=numpy.int64)
+            self.cache[mission] = instr
+            if len(self.cache) > self.max_cache_size:
+                self.cache.popitem(last=False)
+        return instr
 
-        for obs in obss:
-            tokens = re.findall("([a-z]+)", obs["mission"].lower())
-            instr = numpy.array([self.vocab[token] for token in tokens])
-            raw_instrs.append(instr)
-            max_instr_len = max(len(instr), max_instr_len)
-
-        instrs = numpy.zeros((len(obss), max_instr_len))
+    def __call__(self, obss, device=None):
+        raw_instrs = [self.tokenize(mission) for mission in get_missions(obss)]
+        lengths = numpy.array([len(instr) for instr in raw_instrs], dtype=numpy.int64)
+        max_instr_len = lengths.max() if len(lengths) else 0
 
-        for i, instr in enumerate(raw_instrs):
-            instrs[i, :len(instr)] = instr
+        # Fill all the rows at once, the padding is 0
+        instrs = numpy.zeros((len(raw_instrs), max_instr_len), dtype=numpy.int64)
+        if len(raw_instrs):
+            instrs[numpy.arange(max_instr_len) < lengths[:, None]] = numpy.concatenate(raw_instrs)
 
         instrs = torch.tensor(instrs, device=device, dtype=torch.long)
         return instrs
@@ -77,8 +122,9 @@ class InstructionsPreprocessor(object):
 
 class RawImagePreprocessor(object):
     def __call__(self, obss, device=None):
-        images = numpy.array([obs["image"] for obs in obss])
-        images = torch.tensor(images, device=device, dtype=torch.float)
+        images = get_images(obss)
+        # The images stay uint8 until the model converts them on its device
+        images = torch.tensor(images, device=device, dtype=torch.uint8)
         return images
 
 
@@ -90,7 +136,7 @@ class IntImagePreprocessor(object):
         self.max_size = int(num_channels * max_high)
 
     def __call__(self, obss, device=None):
-        images = numpy.array([obs["image"] for obs in obss])
+        images = get_images(obss)
         # The padding index is 0 for all the channels
         images = (images + self.offsets) * (images > 0)
         images = torch.tensor(images, device=device, dtype=torch.long)
@@ -108,7 +154,7 @@ class ObssPreprocessor:
         }
 
     def __call__(self, obss, device=None):
-        obs_ = babyai.rl.DictList()
+        obs_ = babyai.rl.TensorBatch()
 
         if "image" in self.obs_space.keys():
             obs_.image = self.image_preproc(obss, device=device)
@@ -132,7 +178,7 @@ class IntObssPreprocessor(object):
         }
 
     def __call__(self, obss, device=None):
-        obs_ = babyai.rl.DictList()
+        obs_ = babyai.rl.TensorBatch()
 
         if "image" in self.obs_space.keys():
             obs_.image = self.image_preproc(obss, device=device)
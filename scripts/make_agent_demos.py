@@ -6,22 +6,17 @@ Generate a set of agent demonstrations.
 The agent can either be a trained model or the heuristic expert (bot).
 
 Demonstration generation can take a long time, but it can be parallelized
-if you have a cluster at your disposal. Provide a script that launches
-make_agent_demos.py at your cluster as --job-script and the number of jobs as --jobs.
-
-
+over the cores of your machine with --procs. The seeds are split in shards of
+--shard-size episodes, which are saved as soon as they are generated, so an
+interrupted generation resumes where it stopped. The demonstrations only
+depend on the seeds, not on the number of processes. The options --jobs,
+--job-script and --save-interval are deprecated: --jobs is the same as
+--procs, the others are ignored.
 """
 
 import argparse
-import gym
 import logging
-import sys
-import subprocess
-import os
-import time
 import numpy as np
-import blosc
-import torch
 
 import babyai.utils as utils
 
@@ -44,23 +39,25 @@ parser.add_argument("--argmax", action="store_true", default=False,
                     help="action with highest probability is selected")
 parser.add_argument("--log-interval", type=int, default=100,
                     help="interval between progress reports")
-parser.add_argument("--save-interval", type=int, default=10000,
-                    help="interval between demonstrations saving")
 parser.add_argument("--filter-steps", type=int, default=0,
                     help="filter out demos with number of steps more than filter-steps")
 parser.add_argument("--on-exception", type=str, default='warn', choices=('warn', 'crash'),
                     help="How to handle exceptions during demo generation")
+parser.add_argument("--procs", type=int, default=1,
+                    help="number of processes generating demonstrations")
+parser.add_argument("--shard-size", type=int, default=100,
+                    help="number of episodes generated and saved at once by a process")
 
 parser.add_argument("--job-script", type=str, default=None,
-                    help="The script that launches make_agent_demos.py at a cluster.")
+                    help="deprecated and ignored: the demonstrations are generated by local processes")
 parser.add_argument("--jobs", type=int, default=0,
-                    help="Split generation in that many jobs")
+                    help="deprecated: same as --procs")
+parser.add_argument("--save-interval", type=int, default=None,
+                    help="deprecated and ignored: every shard is saved as soon as it is generated")
 
 args = parser.parse_args()
 logger = logging.getLogger(__name__)
 
-# Set seed for all randomness sources
-
 
 def print_demo_lengths(demos):
     num_frames_per_episode = [len(demo[2]) for demo in demos]
@@ -68,83 +65,12 @@ def print_demo_lengths(demos):
         np.mean(num_frames_per_episode), np.std(num_frames_per_episode)))
 
 
-def generate_demos(n_episodes, valid, seed, shift=0):
-    utils.seed(seed)
-
-    # Generate environment
-    env = gym.make(args.env)
-
-    agent = utils.load_agent(env, args.model, args.demos, 'agent', args.argmax, args.env)
+def generate_demos(n_episodes, valid, seed):
     demos_path = utils.get_demos_path(args.demos, args.env, 'agent', valid)
-    demos = []
-
-    checkpoint_time = time.time()
-
-    just_crashed = False
-    while True:
-        if len(demos) == n_episodes:
-            break
-
-        done = False
-        if just_crashed:
-            logger.info("reset the environment to find a mission that the bot can solve")
-            env.reset()
-        else:
-            env.seed(seed + len(demos))
-        obs = env.reset()
-        agent.on_reset()
-
-        actions = []
-        mission = obs["mission"]
-        images = []
-        directions = []
-
-        try:
-            while not done:
-                action = agent.act(obs)['action']
-                if isinstance(action, torch.Tensor):
-                    action = action.item()
-                new_obs, reward, done, _ = env.step(action)
-                agent.analyze_feedback(reward, done)
-
-                actions.append(action)
-                images.append(obs['image'])
-                directions.append(obs['direction'])
-
-                obs = new_obs
-            if reward > 0 and (args.filter_steps == 0 or len(images) <= args.filter_steps):
-                demos.append((mission, blosc.pack_array(np.array(images)), directions, actions))
-                just_crashed = False
-
-            if reward == 0:
-                if args.on_exception == 'crash':
-                    raise Exception("mission failed, the seed is {}".format(seed + len(demos)))
-                just_crashed = True
-                logger.info("mission failed")
-        except (Exception, AssertionError):
-            if args.on_exception == 'crash':
-                raise
-            just_crashed = True
-            logger.exception("error while generating demo #{}".format(len(demos)))
-            continue
-
-        if len(demos) and len(demos) % args.log_interval == 0:
-            now = time.time()
-            demos_per_second = args.log_interval / (now - checkpoint_time)
-            to_go = (n_episodes - len(demos)) / demos_per_second
-            logger.info("demo #{}, {:.3f} demos per second, {:.3f} seconds to go".format(
-                len(demos) - 1, demos_per_second, to_go))
-            checkpoint_time = now
-
-        # Save demonstrations
-
-        if args.save_interval > 0 and len(demos) < n_episodes and len(demos) % args.save_interval == 0:
-            logger.info("Saving demos...")
-            utils.save_demos(demos, demos_path)
-            logger.info("{} demos saved".format(len(demos)))
-            # print statistics for the last 100 demonstrations
-            print_demo_lengths(demos[-100:])
-
+    demos = utils.generate_demos(args.env, range(seed, seed + n_episodes), args.model, args.argmax,
+                                 args.filter_steps, args.on_exception, procs=args.procs,
+                                 shard_size=args.shard_size, shards_path=demos_path,
+                                 log_interval=args.log_interval)
 
     # Save demonstrations
     logger.info("Saving demos...")
@@ -153,66 +79,18 @@ def generate_demos(n_episodes, valid, seed, shift=0):
     print_demo_lengths(demos[-100:])
 
 
-def generate_demos_cluster():
-    demos_per_job = args.episodes // args.jobs
-    demos_path = utils.get_demos_path(args.demos, args.env, 'agent')
-    job_demo_names = [os.path.realpath(demos_path + '.shard{}'.format(i))
-                     for i in range(args.jobs)]
-    for demo_name in job_demo_names:
-        job_demos_path = utils.get_demos_path(demo_name)
-        if os.path.exists(job_demos_path):
-            os.remove(job_demos_path)
-
-    command = [args.job_script]
-    command += sys.argv[1:]
-    for i in range(args.jobs):
-        cmd_i = list(map(str,
-            command
-              + ['--seed', args.seed + i * demos_per_job]
-              + ['--demos', job_demo_names[i]]
-              + ['--episodes', demos_per_job]
-              + ['--jobs', 0]
-              + ['--valid-episodes', 0]))
-        logger.info('LAUNCH COMMAND')
-        logger.info(cmd_i)
-        output = subprocess.check_output(cmd_i)
-        logger.info('LAUNCH OUTPUT')
-        logger.info(output.decode('utf-8'))
-
-    job_demos = [None] * args.jobs
-    while True:
-        jobs_done = 0
-        for i in range(args.jobs):
-            if job_demos[i] is None or len(job_demos[i]) < demos_per_job:
-                try:
-                    logger.info("Trying to load shard {}".format(i))
-                    job_demos[i] = utils.load_demos(utils.get_demos_path(job_demo_names[i]))
-                    logger.info("{} demos ready in shard {}".format(
-                        len(job_demos[i]), i))
-                except Exception:
-                    logger.exception("Failed to load the shard")
-            if job_demos[i] and len(job_demos[i]) == demos_per_job:
-                jobs_done += 1
-        logger.info("{} out of {} shards done".format(jobs_done, args.jobs))
-        if jobs_done == args.jobs:
-            break
-        logger.info("sleep for 60 seconds")
-        time.sleep(60)
-
-    # Training demos
-    all_demos = []
-    for demos in job_demos:
-        all_demos.extend(demos)
-    utils.save_demos(all_demos, demos_path)
-
-
 logging.basicConfig(level='INFO', format="%(asctime)s: %(levelname)s: %(message)s")
+if args.job_script is not None or args.jobs:
+    logger.warning("--job-script and --jobs are deprecated: the demonstrations are generated "
+                   "by --procs local processes")
+    if args.jobs:
+        args.procs = args.jobs
+if args.save_interval is not None:
+    logger.warning("--save-interval is deprecated and ignored: every shard of --shard-size episodes "
+                   "is saved as soon as it is generated")
 logger.info(args)
 # Training demos
-if args.jobs == 0:
-    generate_demos(args.episodes, False, args.seed)
-else:
-    generate_demos_cluster()
+generate_demos(args.episodes, False, args.seed)
 # Validation demos
 if args.valid_episodes:
     generate_demos(args.valid_episodes, True, int(1e9))
@@ -33,7 +33,6 @@ from babyai.evaluate import batch_evaluate, evaluate
 from babyai.utils.agent import BotAgent
 import babyai.utils as utils
 import torch
-import blosc
 from babyai.utils.agent import DemoAgent
 
 # Parse arguments
@@ -55,6 +54,8 @@ parser.add_argument("--phases", type=int, default=1000,
                     help="maximum number of phases to train for")
 parser.add_argument("--save-interval", type=int, default=1,
                     help="number of epochs between two saves (default: 1, 0 means no saving)")
+parser.add_argument("--demo-procs", type=int, default=1,
+                    help="number of processes generating the new demos (default: 1)")
 
 
 logger = logging.getLogger(__name__)
@@ -103,51 +104,7 @@ def evaluate_agent(il_learn, eval_seed, num_eval_demos, return_obss_actions=Fals
         return success_rate, fail_seeds, fail_obss, fail_actions
 
 
-def generate_demos(env_name, seeds):
-    env = gym.make(env_name)
-    agent = BotAgent(env)
-    demos = []
-
-    for seed in seeds:
-        # Run the expert for one episode
-        done = False
-
-        env.seed(int(seed))
-        obs = env.reset()
-        agent.on_reset()
-
-        actions = []
-        mission = obs["mission"]
-        images = []
-        directions = []
-
-        try:
-            while not done:
-                action = agent.act(obs)['action']
-                new_obs, reward, done, _ = env.step(action)
-                agent.analyze_feedback(reward, done)
-
-                actions.append(action)
-                images.append(obs['image'])
-                directions.append(obs['direction'])
-
-                obs = new_obs
-
-            if reward > 0:
-                demos.append((mission, blosc.pack_array(np.array(images)), directions, actions))
-            if reward == 0:
-                logger.info("failed to accomplish the mission")
-
-        except Exception:
-            logger.exception("error while generating demo #{}".format(len(demos)))
-            continue
-
-        # logger.info("demo #{}".format(len(demos)))
-
-    return demos
-
-
-def grow_training_set(il_learn, train_demos, eval_seed, grow_factor, num_eval_demos):
+def grow_training_set(il_learn, train_demos, eval_seed, grow_factor, num_eval_demos, demo_procs=1):
     """
     Grow the training set of demonstrations by some factor
     We specifically generate demos on which the agent fails
@@ -170,7 +127,8 @@ def grow_training_set(il_learn, train_demos, eval_seed, grow_factor, num_eval_de
             fail_seeds = fail_seeds[:num_new_demos]
 
         # Generate demos for the worst performing seeds
-        new_demos = generate_demos(il_learn.args.env, fail_seeds)
+        new_demos = utils.generate_demos(il_learn.args.env, fail_seeds, replace_failures=False,
+                                         procs=demo_procs, shard_size=max(1, -(-len(fail_seeds) // demo_procs)))
         train_demos.extend(new_demos)
 
     return eval_seed
@@ -255,7 +213,8 @@ def main(args):
             il_learn.train_demos,
             eval_seed,
             args.demo_grow_factor,
-            args.num_eval_demos
+            args.num_eval_demos,
+            args.demo_procs
         )
 
         # Save the current demo generation seed
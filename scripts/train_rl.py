@@ -7,10 +7,12 @@ Script to train the agent through reinforcment learning.
 import os
 import logging
 import csv
+import copy
 import json
-import gym
+import functools
 import time
 import datetime
+import gym
 import torch
 import numpy as np
 import subprocess
@@ -34,6 +36,10 @@ parser.add_argument("--reward-scale", type=float, default=20.,
                     help="Reward scale multiplier")
 parser.add_argument("--gae-lambda", type=float, default=0.99,
                     help="lambda coefficient in GAE formula (default: 0.99, 1 means no gae)")
+parser.add_argument("--advantage-estimator", default="gae", choices=["gae", "nstep", "vtrace"],
+                    help="how the advantages are computed (default: gae)")
+parser.add_argument("--n-steps", type=int, default=5,
+                    help="number of steps of the returns of the nstep advantage estimator (default: 5)")
 parser.add_argument("--value-loss-coef", type=float, default=0.5,
                     help="value loss term coefficient (default: 0.5)")
 parser.add_argument("--max-grad-norm", type=float, default=0.5,
@@ -44,206 +50,295 @@ parser.add_argument("--ppo-epochs", type=int, default=4,
                     help="number of epochs for PPO (default: 4)")
 parser.add_argument("--save-interval", type=int, default=50,
                     help="number of updates between two saves (default: 50, 0 means no saving)")
-args = parser.parse_args()
-
-utils.seed(args.seed)
-
-# Generate environments
-envs = []
-for i in range(args.procs):
-    env = gym.make(args.env)
-    env.seed(100 * args.seed + i)
-    envs.append(env)
-
-# Define model name
-suffix = datetime.datetime.now().strftime("%y-%m-%d-%H-%M-%S")
-instr = args.instr_arch if args.instr_arch else "noinstr"
-mem = "mem" if not args.no_mem else "nomem"
-model_name_parts = {
-    'env': args.env,
-    'algo': args.algo,
-    'arch': args.arch,
-    'instr': instr,
-    'mem': mem,
-    'seed': args.seed,
-    'info': '',
-    'coef': '',
-    'suffix': suffix}
-default_model_name = "{env}_{algo}_{arch}_{instr}_{mem}_seed{seed}{info}{coef}_{suffix}".format(**model_name_parts)
-if args.pretrained_model:
-    default_model_name = args.pretrained_model + '_pretrained_' + default_model_name
-args.model = args.model.format(**model_name_parts) if args.model else default_model_name
-
-utils.configure_logging(args.model)
-logger = logging.getLogger(__name__)
-
-# Define obss preprocessor
-if 'emb' in args.arch:
-    obss_preprocessor = utils.IntObssPreprocessor(args.model, envs[0].observation_space, args.pretrained_model)
-else:
-    obss_preprocessor = utils.ObssPreprocessor(args.model, envs[0].observation_space, args.pretrained_model)
-
-# Define actor-critic model
-acmodel = utils.load_model(args.model, raise_not_found=False)
-if acmodel is None:
+parser.add_argument("--shared-memory", action="store_true", default=False,
+                    help="transport observations from the env processes through shared memory")
+parser.add_argument("--envs-per-proc", type=int, default=1,
+                    help="number of environments stepped by each env process (default: 1)")
+parser.add_argument("--min-ready", type=int, default=None,
+                    help="step the environments asynchronously, running the model as soon as "
+                         "this many environments are ready (default: synchronous stepping)")
+parser.add_argument("--pregenerate", type=int, default=0,
+                    help="number of episodes each environment generates in advance (default: 0)")
+parser.add_argument("--batched-obs", action="store_true", default=False,
+                    help="get the observations of all the environments as stacked arrays")
+parser.add_argument("--start-method", default=None, choices=["fork", "forkserver", "spawn"],
+                    help="how to start the env processes (default: the platform's default)")
+parser.add_argument("--actors", type=int, default=0,
+                    help="number of actor processes that collect experiences while the model "
+                         "is updated (default: 0, the experiences are collected between updates)")
+parser.add_argument("--worker-inference", action="store_true", default=False,
+                    help="run the model in the env processes, each one stepping --envs-per-proc "
+                         "environments, and collect the experiences between updates")
+parser.add_argument("--actor-queue-size", type=int, default=1,
+                    help="number of rollouts each actor can collect in advance (default: 1)")
+parser.add_argument("--world-size", type=int, default=1,
+                    help="number of learners, which split the environments and average "
+                         "their gradients (default: 1)")
+parser.add_argument("--rank", type=int, default=0,
+                    help="rank of the (first) learner run by this command (default: 0)")
+parser.add_argument("--dist-url", default="tcp://127.0.0.1:23456",
+                    help="address of learner 0 for the other learners to connect to "
+                         "(default: tcp://127.0.0.1:23456)")
+parser.add_argument("--local-learners", type=int, default=1,
+                    help="number of learners run by this command, with consecutive ranks (default: 1)")
+
+
+def main(args, store=None):
+    # With several learners, `store` is the store of their process group, and
+    # only learner 0 logs, saves and evaluates the model
+    is_main = args.rank == 0
+
+    utils.seed(args.seed + args.rank)
+
+    # Generate environments, each one is constructed in the process that runs it
+    procs = args.procs // args.world_size
+    envs = [functools.partial(babyai.rl.utils.make_env, args.env, 100 * args.seed + i)
+            for i in range(args.rank * procs, (args.rank + 1) * procs)]
+    if args.actors > 0 or args.worker_inference:
+        # The actors are started once the model is defined, get the spaces from another environment
+        penv = gym.make(args.env)
+    else:
+        penv = babyai.rl.ParallelEnv(envs, args.shared_memory, args.envs_per_proc, args.pregenerate,
+                                     args.start_method, args.batched_obs)
+
+    # Define model name
+    suffix = datetime.datetime.now().strftime("%y-%m-%d-%H-%M-%S")
+    instr = args.instr_arch if args.instr_arch else "noinstr"
+    mem = "mem" if not args.no_mem else "nomem"
+    model_name_parts = {
+        'env': args.env,
+        'algo': args.algo,
+        'arch': args.arch,
+        'instr': instr,
+        'mem': mem,
+        'seed': args.seed,
+        'info': '',
+        'coef': '',
+        'suffix': suffix}
+    default_model_name = "{env}_{algo}_{arch}_{instr}_{mem}_seed{seed}{info}{coef}_{suffix}".format(**model_name_parts)
     if args.pretrained_model:
-        acmodel = utils.load_model(args.pretrained_model, raise_not_found=True)
+        default_model_name = args.pretrained_model + '_pretrained_' + default_model_name
+    args.model = args.model.format(**model_name_parts) if args.model else default_model_name
+    if args.world_size > 1:
+        model_name = [args.model]
+        torch.distributed.broadcast_object_list(model_name)
+        args.model = model_name[0]
+
+    if is_main:
+        utils.configure_logging(args.model)
+    logger = logging.getLogger(__name__)
+
+    # Define obss preprocessor
+    if 'emb' in args.arch:
+        obss_preprocessor = utils.IntObssPreprocessor(args.model, penv.observation_space, args.pretrained_model)
     else:
-        acmodel = ACModel(obss_preprocessor.obs_space, envs[0].action_space,
-                          args.image_dim, args.memory_dim, args.instr_dim,
-                          not args.no_instr, args.instr_arch, not args.no_mem, args.arch)
-
-obss_preprocessor.vocab.save()
-utils.save_model(acmodel, args.model)
-
-if torch.cuda.is_available():
-    acmodel.cuda()
-
-# Define actor-critic algo
-
-reshape_reward = lambda _0, _1, reward, _2: args.reward_scale * reward
-if args.algo == "ppo":
-    algo = babyai.rl.PPOAlgo(envs, acmodel, args.frames_per_proc, args.discount, args.lr, args.beta1, args.beta2,
-                             args.gae_lambda,
-                             args.entropy_coef, args.value_loss_coef, args.max_grad_norm, args.recurrence,
-                             args.optim_eps, args.clip_eps, args.ppo_epochs, args.batch_size, obss_preprocessor,
-                             reshape_reward)
-else:
-    raise ValueError("Incorrect algorithm name: {}".format(args.algo))
-
-# When using extra binary information, more tensors (model params) are initialized compared to when we don't use that.
-# Thus, there starts to be a difference in the random state. If we want to avoid it, in order to make sure that
-# the results of supervised-loss-coef=0. and extra-binary-info=0 match, we need to reseed here.
-
-utils.seed(args.seed)
-
-# Restore training status
-
-status_path = os.path.join(utils.get_log_dir(args.model), 'status.json')
-if os.path.exists(status_path):
-    with open(status_path, 'r') as src:
-        status = json.load(src)
-else:
-    status = {'i': 0,
-              'num_episodes': 0,
-              'num_frames': 0}
-
-# Define logger and Tensorboard writer and CSV writer
-
-header = (["update", "episodes", "frames", "FPS", "duration"]
-          + ["return_" + stat for stat in ['mean', 'std', 'min', 'max']]
-          + ["success_rate"]
-          + ["num_frames_" + stat for stat in ['mean', 'std', 'min', 'max']]
-          + ["entropy", "value", "policy_loss", "value_loss", "loss", "grad_norm"])
-if args.tb:
-    from tensorboardX import SummaryWriter
-
-    writer = SummaryWriter(utils.get_log_dir(args.model))
-csv_path = os.path.join(utils.get_log_dir(args.model), 'log.csv')
-first_created = not os.path.exists(csv_path)
-# we don't buffer data going in the csv log, cause we assume
-# that one update will take much longer that one write to the log
-csv_writer = csv.writer(open(csv_path, 'a', 1))
-if first_created:
-    csv_writer.writerow(header)
-
-# Log code state, command, availability of CUDA and model
-
-babyai_code = list(babyai.__path__)[0]
-try:
-    last_commit = subprocess.check_output(
-        'cd {}; git log -n1'.format(babyai_code), shell=True).decode('utf-8')
-    logger.info('LAST COMMIT INFO:')
-    logger.info(last_commit)
-except subprocess.CalledProcessError:
-    logger.info('Could not figure out the last commit')
-try:
-    diff = subprocess.check_output(
-        'cd {}; git diff'.format(babyai_code), shell=True).decode('utf-8')
-    if diff:
-        logger.info('GIT DIFF:')
-        logger.info(diff)
-except subprocess.CalledProcessError:
-    logger.info('Could not figure out the last commit')
-logger.info('COMMAND LINE ARGS:')
-logger.info(args)
-logger.info("CUDA available: {}".format(torch.cuda.is_available()))
-logger.info(acmodel)
-
-# Train model
-
-total_start_time = time.time()
-best_success_rate = 0
-best_mean_return = 0
-test_env_name = args.env
-while status['num_frames'] < args.frames:
-    # Update parameters
-
-    update_start_time = time.time()
-    logs = algo.update_parameters()
-    update_end_time = time.time()
-
-    status['num_frames'] += logs["num_frames"]
-    status['num_episodes'] += logs['episodes_done']
-    status['i'] += 1
-
-    # Print logs
-
-    if status['i'] % args.log_interval == 0:
-        total_ellapsed_time = int(time.time() - total_start_time)
-        fps = logs["num_frames"] / (update_end_time - update_start_time)
-        duration = datetime.timedelta(seconds=total_ellapsed_time)
-        return_per_episode = utils.synthesize(logs["return_per_episode"])
-        success_per_episode = utils.synthesize(
-            [1 if r > 0 else 0 for r in logs["return_per_episode"]])
-        num_frames_per_episode = utils.synthesize(logs["num_frames_per_episode"])
-
-        data = [status['i'], status['num_episodes'], status['num_frames'],
-                fps, total_ellapsed_time,
-                *return_per_episode.values(),
-                success_per_episode['mean'],
-                *num_frames_per_episode.values(),
-                logs["entropy"], logs["value"], logs["policy_loss"], logs["value_loss"],
-                logs["loss"], logs["grad_norm"]]
-
-        format_str = ("U {} | E {} | F {:06} | FPS {:04.0f} | D {} | R:xsmM {: .2f} {: .2f} {: .2f} {: .2f} | "
-                      "S {:.2f} | F:xsmM {:.1f} {:.1f} {} {} | H {:.3f} | V {:.3f} | "
-                      "pL {: .3f} | vL {:.3f} | L {:.3f} | gN {:.3f} | ")
-
-        logger.info(format_str.format(*data))
-        if args.tb:
-            assert len(header) == len(data)
-            for key, value in zip(header, data):
-                writer.add_scalar(key, float(value), status['num_frames'])
+        obss_preprocessor = utils.ObssPreprocessor(args.model, penv.observation_space, args.pretrained_model)
 
-        csv_writer.writerow(data)
-
-    # Save obss preprocessor vocabulary and model
+    # Define actor-critic model
+    acmodel = utils.load_model(args.model, raise_not_found=False)
+    if acmodel is None:
+        if args.pretrained_model:
+            acmodel = utils.load_model(args.pretrained_model, raise_not_found=True)
+        else:
+            acmodel = ACModel(obss_preprocessor.obs_space, penv.action_space,
+                              args.image_dim, args.memory_dim, args.instr_dim,
+                              not args.no_instr, args.instr_arch, not args.no_mem, args.arch)
 
-    if args.save_interval > 0 and status['i'] % args.save_interval == 0:
+    if args.world_size > 1:
+        babyai.rl.utils.distributed.share_vocab(obss_preprocessor.vocab, store, args.rank)
+    if is_main:
         obss_preprocessor.vocab.save()
-        with open(status_path, 'w') as dst:
-            json.dump(status, dst)
-            utils.save_model(acmodel, args.model)
-
-        # Testing the model before saving
-        agent = ModelAgent(args.model, obss_preprocessor, argmax=True)
-        agent.model = acmodel
-        agent.model.eval()
-        logs = batch_evaluate(agent, test_env_name, args.val_seed, args.val_episodes)
-        agent.model.train()
-        mean_return = np.mean(logs["return_per_episode"])
-        success_rate = np.mean([1 if r > 0 else 0 for r in logs['return_per_episode']])
-        save_model = False
-        if success_rate > best_success_rate:
-            best_success_rate = success_rate
-            save_model = True
-        elif (success_rate == best_success_rate) and (mean_return > best_mean_return):
-            best_mean_return = mean_return
-            save_model = True
-        if save_model:
-            utils.save_model(acmodel, args.model + '_best')
-            obss_preprocessor.vocab.save(utils.get_vocab_path(args.model + '_best'))
-            logger.info("Return {: .2f}; best model is saved".format(mean_return))
-        else:
-            logger.info("Return {: .2f}; not the best model; not saved".format(mean_return))
+        utils.save_model(acmodel, args.model)
+    if args.world_size > 1:
+        # The other learners have loaded the model, if it existed, before it is saved
+        torch.distributed.barrier()
+
+    if torch.cuda.is_available():
+        acmodel.cuda()
+
+    # Define actor-critic algo
+
+    reshape_reward = babyai.rl.ScaledReward(args.reward_scale)
+    if args.actors > 0:
+        penv = babyai.rl.ActorPool(envs, acmodel, obss_preprocessor, args.frames_per_proc, args.actors,
+                                   reshape_reward, args.actor_queue_size, args.start_method, seed=args.seed)
+    elif args.worker_inference:
+        num_workers = -(-len(envs) // args.envs_per_proc)
+        penv = babyai.rl.ActorPool(envs, acmodel, obss_preprocessor, args.frames_per_proc, num_workers,
+                                   reshape_reward, start_method=args.start_method, synchronous=True,
+                                   seed=args.seed)
+    if args.algo == "ppo":
+        algo = babyai.rl.PPOAlgo(penv, acmodel, args.frames_per_proc, args.discount, args.lr, args.beta1, args.beta2,
+                                 args.gae_lambda,
+                                 args.entropy_coef, args.value_loss_coef, args.max_grad_norm, args.recurrence,
+                                 args.optim_eps, args.clip_eps, args.ppo_epochs, args.batch_size // args.world_size,
+                                 obss_preprocessor, reshape_reward, min_ready=args.min_ready,
+                                 advantage_estimator=args.advantage_estimator, n_steps=args.n_steps,
+                                 distributed=args.world_size > 1)
+    else:
+        raise ValueError("Incorrect algorithm name: {}".format(args.algo))
+
+    # When using extra binary information, more tensors (model params) are initialized compared to when we don't use that.
+    # Thus, there starts to be a difference in the random state. If we want to avoid it, in order to make sure that
+    # the results of supervised-loss-coef=0. and extra-binary-info=0 match, we need to reseed here.
+
+    utils.seed(args.seed + args.rank)
+
+    # Restore training status
+
+    status_path = os.path.join(utils.get_log_dir(args.model), 'status.json')
+    if os.path.exists(status_path):
+        with open(status_path, 'r') as src:
+            status = json.load(src)
+    else:
+        status = {'i': 0,
+                  'num_episodes': 0,
+                  'num_frames': 0}
+
+    # Define logger and Tensorboard writer and CSV writer
+
+    header = (["update", "episodes", "frames", "FPS", "duration"]
+              + ["return_" + stat for stat in ['mean', 'std', 'min', 'max']]
+              + ["success_rate"]
+              + ["num_frames_" + stat for stat in ['mean', 'std', 'min', 'max']]
+              + ["entropy", "value", "policy_loss", "value_loss", "loss", "grad_norm"])
+    if is_main:
+        if args.tb:
+            from tensorboardX import SummaryWriter
+
+            writer = SummaryWriter(utils.get_log_dir(args.model))
+        csv_path = os.path.join(utils.get_log_dir(args.model), 'log.csv')
+        first_created = not os.path.exists(csv_path)
+        # we don't buffer data going in the csv log, cause we assume
+        # that one update will take much longer that one write to the log
+        csv_writer = csv.writer(open(csv_path, 'a', 1))
+        if first_created:
+            csv_writer.writerow(header)
+
+        # Log code state, command, availability of CUDA and model
+
+        babyai_code = list(babyai.__path__)[0]
+        try:
+            last_commit = subprocess.check_output(
+                'cd {}; git log -n1'.format(babyai_code), shell=True).decode('utf-8')
+            logger.info('LAST COMMIT INFO:')
+            logger.info(last_commit)
+        except subprocess.CalledProcessError:
+            logger.info('Could not figure out the last commit')
+        try:
+            diff = subprocess.check_output(
+                'cd {}; git diff'.format(babyai_code), shell=True).decode('utf-8')
+            if diff:
+                logger.info('GIT DIFF:')
+                logger.info(diff)
+        except subprocess.CalledProcessError:
+            logger.info('Could not figure out the last commit')
+        logger.info('COMMAND LINE ARGS:')
+        logger.info(args)
+        logger.info("CUDA available: {}".format(torch.cuda.is_available()))
+        logger.info(acmodel)
+
+    # Train model
+
+    total_start_time = time.time()
+    best_success_rate = 0
+    best_mean_return = 0
+    test_env_name = args.env
+    while status['num_frames'] < args.frames:
+        # Update parameters
+
+        update_start_time = time.time()
+        logs = algo.update_parameters()
+        if args.world_size > 1:
+            logs = babyai.rl.utils.distributed.gather_logs(logs)
+        update_end_time = time.time()
+
+        status['num_frames'] += logs["num_frames"]
+        status['num_episodes'] += logs['episodes_done']
+        status['i'] += 1
+
+        # Print logs
+
+        if is_main and status['i'] % args.log_interval == 0:
+            total_ellapsed_time = int(time.time() - total_start_time)
+            fps = logs["num_frames"] / (update_end_time - update_start_time)
+            duration = datetime.timedelta(seconds=total_ellapsed_time)
+            return_per_episode = utils.synthesize(logs["return_per_episode"])
+            success_per_episode = utils.synthesize(
+                [1 if r > 0 else 0 for r in logs["return_per_episode"]])
+            num_frames_per_episode = utils.synthesize(logs["num_frames_per_episode"])
+
+            data = [status['i'], status['num_episodes'], status['num_frames'],
+                    fps, total_ellapsed_time,
+                    *return_per_episode.values(),
+                    success_per_episode['mean'],
+                    *num_frames_per_episode.values(),
+                    logs["entropy"], logs["value"], logs["policy_loss"], logs["value_loss"],
+                    logs["loss"], logs["grad_norm"]]
+
+            format_str = ("U {} | E {} | F {:06} | FPS {:04.0f} | D {} | R:xsmM {: .2f} {: .2f} {: .2f} {: .2f} | "
+                          "S {:.2f} | F:xsmM {:.1f} {:.1f} {} {} | H {:.3f} | V {:.3f} | "
+                          "pL {: .3f} | vL {:.3f} | L {:.3f} | gN {:.3f} | ")
+
+            logger.info(format_str.format(*data))
+            if args.tb:
+                assert len(header) == len(data)
+                for key, value in zip(header, data):
+                    writer.add_scalar(key, float(value), status['num_frames'])
+
+            csv_writer.writerow(data)
+
+        # Save obss preprocessor vocabulary and model
+
+        if is_main and args.save_interval > 0 and status['i'] % args.save_interval == 0:
+            obss_preprocessor.vocab.save()
+            with open(status_path, 'w') as dst:
+                json.dump(status, dst)
+                utils.save_model(acmodel, args.model)
+
+            # Testing the model before saving
+            agent = ModelAgent(args.model, obss_preprocessor, argmax=True)
+            agent.model = acmodel
+            agent.model.eval()
+            logs = batch_evaluate(agent, test_env_name, args.val_seed, args.val_episodes)
+            agent.model.train()
+            mean_return = np.mean(logs["return_per_episode"])
+            success_rate = np.mean([1 if r > 0 else 0 for r in logs['return_per_episode']])
+            save_model = False
+            if success_rate > best_success_rate:
+                best_success_rate = success_rate
+                save_model = True
+            elif (success_rate == best_success_rate) and (mean_return > best_mean_return):
+                best_mean_return = mean_return
+                save_model = True
+            if save_model:
+                utils.save_model(acmodel, args.model + '_best')
+                obss_preprocessor.vocab.save(utils.get_vocab_path(args.model + '_best'))
+                logger.info("Return {: .2f}; best model is saved".format(mean_return))
+            else:
+                logger.info("Return {: .2f}; not the best model; not saved".format(mean_return))
+
+    penv.close()
+
+
+def run_learner(local_rank, args):
+    args = copy.copy(args)
+    args.rank += local_rank
+    store = babyai.rl.utils.distributed.init_distributed(args.dist_url, args.world_size, args.rank)
+    main(args, store)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.actors > 0 and args.worker_inference:
+        parser.error("--actors and --worker-inference cannot be used together")
+    if args.world_size == 1:
+        main(args)
+    elif args.procs % args.world_size != 0 or args.batch_size % args.world_size != 0:
+        parser.error("--procs and --batch-size should be divisible by --world-size")
+    elif args.actors > 0 or args.worker_inference:
+        parser.error("--actors and --worker-inference are not supported with several learners")
+    elif args.local_learners == 1:
+        run_learner(0, args)
+    else:
+        torch.multiprocessing.spawn(run_learner, (args,), args.local_learners)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Find the fastest --procs, --frames-per-proc, --batch-size, --recurrence and
+number of torch threads for training a model on a level on this machine.
+
+Every configuration of the search space is run for a few PPO updates, and
+the frames per second of collecting experiences and of whole updates are
+reported. Only the speed is measured: the batch size and recurrence also
+change what is learned.
+"""
+
+import argparse
+import functools
+import gc
+import itertools
+import time
+import torch
+
+import babyai.utils as utils
+import babyai.rl
+from babyai.model import ACModel
+
+# Parse arguments
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--env", required=True,
+                    help="name of the environment to train on (REQUIRED)")
+parser.add_argument("--arch", default='expert_filmcnn',
+                    help="image embedding architecture (default: expert_filmcnn)")
+parser.add_argument("--instr-arch", default="gru",
+                    help="arch to encode instructions (default: gru)")
+parser.add_argument("--image-dim", type=int, default=128,
+                    help="dimensionality of the image embedding (default: 128)")
+parser.add_argument("--memory-dim", type=int, default=128,
+                    help="dimensionality of the memory LSTM (default: 128)")
+parser.add_argument("--instr-dim", type=int, default=128,
+                    help="dimensionality of the instruction embedding (default: 128)")
+parser.add_argument("--procs", type=int, nargs="+", default=[16, 32, 64],
+                    help="numbers of processes to try (default: 16 32 64)")
+parser.add_argument("--frames-per-proc", type=int, nargs="+", default=[40, 80],
+                    help="numbers of frames per process to try (default: 40 80)")
+parser.add_argument("--batch-size", type=int, nargs="+", default=[640, 1280],
+                    help="batch sizes to try (default: 640 1280)")
+parser.add_argument("--recurrence", type=int, nargs="+", default=[20],
+                    help="recurrences to try (default: 20)")
+parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4],
+                    help="numbers of torch threads to try (default: 1 2 4)")
+parser.add_argument("--envs-per-proc", type=int, default=1,
+                    help="number of environments stepped by each env process (default: 1)")
+parser.add_argument("--shared-memory", action="store_true", default=False,
+                    help="transport observations from the env processes through shared memory")
+parser.add_argument("--updates", type=int, default=2,
+                    help="number of timed updates per configuration, after one warm-up update (default: 2)")
+parser.add_argument("--seed", type=int, default=1,
+                    help="random seed (default: 1)")
+
+
+def run_trial(args, procs, frames_per_proc, batch_size, recurrence, threads):
+    """Returns the frames per second of collecting experiences, and of whole updates."""
+    torch.set_num_threads(threads)
+    utils.seed(args.seed)
+
+    envs = [functools.partial(babyai.rl.utils.make_env, args.env, 100 * args.seed + i)
+            for i in range(procs)]
+    penv = babyai.rl.ParallelEnv(envs, args.shared_memory, args.envs_per_proc)
+    obss_preprocessor = utils.ObssPreprocessor('tune_throughput', penv.observation_space)
+    acmodel = ACModel(obss_preprocessor.obs_space, penv.action_space,
+                      args.image_dim, args.memory_dim, args.instr_dim,
+                      True, args.instr_arch, True, args.arch)
+    if torch.cuda.is_available():
+        acmodel.cuda()
+    algo = babyai.rl.PPOAlgo(penv, acmodel, frames_per_proc, recurrence=recurrence, batch_size=batch_size,
+                             preprocess_obss=obss_preprocessor,
+                             reshape_reward=babyai.rl.ScaledReward(20.))
+
+    # Time the collection of the experiences within the updates
+    collect_times = []
+    collect_experiences = algo.collect_experiences
+
+    def timed_collect_experiences():
+        start_time = time.time()
+        result = collect_experiences()
+        collect_times.append(time.time() - start_time)
+        return result
+    algo.collect_experiences = timed_collect_experiences
+
+    algo.update_parameters()
+    collect_times.clear()
+    start_time = time.time()
+    for _ in range(args.updates):
+        algo.update_parameters()
+    update_time = time.time() - start_time
+
+    penv.close()
+    del algo, penv
+    gc.collect()
+
+    num_frames = args.updates * procs * frames_per_proc
+    return num_frames / sum(collect_times), num_frames / update_time
+
+
+def main(args):
+    results = []
+    for procs, frames_per_proc, batch_size, recurrence, threads in itertools.product(
+            args.procs, args.frames_per_proc, args.batch_size, args.recurrence, args.threads):
+        config = {'procs': procs, 'frames_per_proc': frames_per_proc, 'batch_size': batch_size,
+                  'recurrence': recurrence, 'threads': threads}
+        if frames_per_proc % recurrence != 0 or batch_size % recurrence != 0:
+            print("Skipping {}: the recurrence should divide the frames per process and the batch size"
+                  .format(config))
+            continue
+        collect_fps, update_fps = run_trial(args, **config)
+        results.append((update_fps, collect_fps, config))
+        print("{} | collect FPS {:.0f} | update FPS {:.0f}".format(config, collect_fps, update_fps), flush=True)
+
+    if not results:
+        print("No valid configuration")
+        return
+
+    print()
+    print("Configurations by update FPS:")
+    results.sort(key=lambda result: result[0], reverse=True)
+    for update_fps, collect_fps, config in results:
+        print("update FPS {:6.0f} | collect FPS {:6.0f} | {}".format(update_fps, collect_fps, config))
+
+    _, _, best = results[0]
+    print()
+    print("Best configuration:")
+    print("OMP_NUM_THREADS={threads} python -m scripts.train_rl --env {env} --arch {arch} --instr-arch {instr_arch} "
+          "--image-dim {image_dim} --memory-dim {memory_dim} --instr-dim {instr_dim} --procs {procs} "
+          "--frames-per-proc {frames_per_proc} --batch-size {batch_size} --recurrence {recurrence}"
+          .format(env=args.env, arch=args.arch, instr_arch=args.instr_arch, image_dim=args.image_dim,
+                  memory_dim=args.memory_dim, instr_dim=args.instr_dim, **best)
+          + (" --envs-per-proc {}".format(args.envs_per_proc) if args.envs_per_proc > 1 else "")
+          + (" --shared-memory" if args.shared_memory else ""))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,46 @@
+"""
+Check that the actors of an ActorPool explore independently.
+"""
+
+import functools
+import gym
+import pytest
+import torch
+
+import babyai.utils as utils
+from babyai.model import ACModel
+from babyai.rl.utils import ActorPool, make_env
+
+ENV_NAME = 'BabyAI-GoToObjS4-v0'
+NUM_FRAMES = 20
+
+
+def make_pool(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setenv("BABYAI_STORAGE", str(tmp_path))
+    env = gym.make(ENV_NAME)
+    obss_preprocessor = utils.ObssPreprocessor('test_actors', env.observation_space)
+    torch.manual_seed(0)
+    model = ACModel(obss_preprocessor.obs_space, env.action_space, 16, 16, 16,
+                    use_instr=True, use_memory=True)
+    # The same environment for both actors
+    envs = [functools.partial(make_env, ENV_NAME, 1)] * 2
+    return ActorPool(envs, model, obss_preprocessor, NUM_FRAMES, 2, seed=0, **kwargs), model
+
+
+@pytest.mark.parametrize("synchronous", [False, True])
+def test_actors_sample_differently(tmp_path, monkeypatch, synchronous):
+    # Synchronous actors are the workers of --worker-inference
+    pool, model = make_pool(tmp_path, monkeypatch, synchronous=synchronous)
+    pool.update_weights(model)
+    actions = pool.get_rollout()["action"]
+    assert not torch.equal(actions[:, 0], actions[:, 1])
+
+
+def test_dead_actor(tmp_path, monkeypatch):
+    pool, model = make_pool(tmp_path, monkeypatch, synchronous=True)
+    # The actors wait for weights, so the killed actor has not put a rollout yet
+    pool.processes[1].terminate()
+    pool.processes[1].join()
+    pool.update_weights(model)
+    with pytest.raises(RuntimeError, match="actor 1"):
+        pool.get_rollout()
@@ -0,0 +1,50 @@
+"""
+Check that the generated demos only depend on the seeds and the generating arguments.
+"""
+
+import os
+import torch
+
+import babyai.utils as utils
+
+ENV_NAME = 'BabyAI-GoToObjS4-v0'
+SEEDS = range(10, 22)
+
+
+def test_procs_and_shards():
+    expected = utils.generate_demos(ENV_NAME, SEEDS)
+    assert len(expected) == len(SEEDS)
+    assert utils.generate_demos(ENV_NAME, SEEDS, procs=3, shard_size=5) == expected
+
+
+def test_threads_unchanged():
+    # e.g. the imitation learning of train_intelligent_expert.py
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(2)
+    try:
+        utils.generate_demos(ENV_NAME, SEEDS[:2])
+        assert torch.get_num_threads() == 2
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def save_shard(shard_path, demos, **params):
+    params = dict({'env': ENV_NAME, 'seeds': [10, 11, 12, 13], 'model': 'BOT', 'argmax': True,
+                   'filter_steps': 0, 'replace_failures': True}, **params)
+    utils.save_demos({'params': params, 'demos': demos}, shard_path)
+
+
+def test_resume(tmp_path):
+    shards_path = str(tmp_path / 'demos.pkl')
+    expected = utils.generate_demos(ENV_NAME, SEEDS, shard_size=4)
+
+    # A shard left by an interrupted generation is reused
+    shard_path = shards_path + '.shard10-13'
+    save_shard(shard_path, expected[1:4])
+    demos = utils.generate_demos(ENV_NAME, SEEDS, shard_size=4, shards_path=shards_path)
+    assert demos == expected[1:4] + expected[4:]
+    assert not os.path.exists(shard_path)
+
+    # But not if it was generated with other arguments
+    save_shard(shard_path, expected[1:4], filter_steps=5)
+    assert utils.generate_demos(ENV_NAME, SEEDS, shard_size=4, shards_path=shards_path) == expected
@@ -0,0 +1,77 @@
+"""
+Check that the cached instruction embeddings are the ones of the current model.
+"""
+
+import gym
+import pytest
+import torch
+
+import babyai
+import babyai.utils as utils
+from babyai.model import ACModel
+from babyai.rl.utils import InstrEmbeddingCache
+
+ENV_NAME = 'BabyAI-GoToLocal-v0'
+
+
+@pytest.fixture
+def env_and_preprocessor(tmp_path, monkeypatch):
+    monkeypatch.setenv("BABYAI_STORAGE", str(tmp_path))
+    env = gym.make(ENV_NAME)
+    return env, utils.ObssPreprocessor('test_instr_cache', env.observation_space)
+
+
+def make_model(env, obss_preprocessor, lang_model, seed):
+    torch.manual_seed(seed)
+    model = ACModel(obss_preprocessor.obs_space, env.action_space, use_instr=True,
+                    lang_model=lang_model, use_memory=True)
+    model.eval()
+    return model
+
+
+def get_obss(env, num_obss):
+    obss = []
+    for seed in range(num_obss):
+        env.seed(seed)
+        obss.append(env.reset())
+    # Repeated missions, as within episodes
+    return obss + obss[:2]
+
+
+@pytest.mark.parametrize("lang_model", ["gru", "attgru"])
+def test_cache_matches_model(env_and_preprocessor, lang_model):
+    env, obss_preprocessor = env_and_preprocessor
+    model = make_model(env, obss_preprocessor, lang_model, 0)
+    cache = InstrEmbeddingCache(model)
+    obs = obss_preprocessor(get_obss(env, 4))
+    memory = torch.zeros(len(obs), model.memory_size)
+
+    for _ in range(2):
+        with torch.no_grad():
+            expected = model(obs, memory)
+            results = model(obs, memory, cache(obs.instr))
+        assert torch.allclose(results['dist'].probs, expected['dist'].probs, atol=1e-6)
+        assert torch.allclose(results['value'], expected['value'], atol=1e-6)
+
+        # The cache is emptied when the language model is updated
+        with torch.no_grad():
+            model.word_embedding.weight.add_(0.1)
+
+
+def test_agent_model_swap(env_and_preprocessor):
+    env, obss_preprocessor = env_and_preprocessor
+    agent = babyai.utils.ModelAgent(make_model(env, obss_preprocessor, "gru", 0), obss_preprocessor, True)
+    obss = get_obss(env, 4)
+    agent.act_batch(obss)
+
+    # As done by the validation of imitation learning and RL
+    model = make_model(env, obss_preprocessor, "gru", 1)
+    agent.model = model
+    agent.memory = None
+    results = agent.act_batch(obss)
+
+    obs = obss_preprocessor(obss)
+    with torch.no_grad():
+        expected = model(obs, torch.zeros(len(obs), model.memory_size))
+    assert torch.allclose(results['dist'].probs, expected['dist'].probs, atol=1e-6)
+    assert torch.allclose(results['value'], expected['value'], atol=1e-6)
@@ -0,0 +1,61 @@
+"""
+Check that ACModel.forward_sequence gives the results of a loop over forward.
+"""
+
+import gym
+import numpy
+import pytest
+import torch
+
+import babyai.utils as utils
+from babyai.model import ACModel
+from babyai.rl.utils.actors import merge_obss
+
+ENV_NAME = 'BabyAI-GoToLocal-v0'
+T, B = 6, 3
+
+
+@pytest.fixture
+def sequence(tmp_path, monkeypatch):
+    monkeypatch.setenv("BABYAI_STORAGE", str(tmp_path))
+    envs = [gym.make(ENV_NAME) for _ in range(B)]
+    for i, env in enumerate(envs):
+        env.seed(i)
+    obss_preprocessor = utils.ObssPreprocessor('test_model', envs[0].observation_space)
+
+    rng = numpy.random.RandomState(0)
+    obss = [env.reset() for env in envs]
+    steps = []
+    for _ in range(T):
+        steps.append(obss_preprocessor(obss))
+        obss = [env.step(rng.randint(3))[0] for env in envs]
+    obs = merge_obss(steps, torch.stack, 0)
+
+    # The memory is reset in the middle of the sequence
+    mask = torch.ones(T, B)
+    mask[2, 0] = mask[4, 1] = 0
+    return obss_preprocessor, envs[0].action_space, obs, mask
+
+
+@pytest.mark.parametrize("arch", ["cnn1", "expert_filmcnn"])
+@pytest.mark.parametrize("lang_model", ["gru", "bigru", "attgru"])
+def test_forward_sequence(sequence, arch, lang_model):
+    obss_preprocessor, action_space, obs, mask = sequence
+    torch.manual_seed(0)
+    model = ACModel(obss_preprocessor.obs_space, action_space, 32, 32, 32,
+                    use_instr=True, lang_model=lang_model, use_memory=True, arch=arch)
+    # Batch normalization uses its running statistics, so the frames are independent
+    model.eval()
+    memory = torch.rand(B, model.memory_size)
+
+    with torch.no_grad():
+        results = model.forward_sequence(obs, memory, mask)
+
+        step_memory = memory
+        for t in range(T):
+            assert torch.allclose(results['memories'][t], step_memory, atol=1e-5)
+            step = model(obs[t], step_memory * mask[t].unsqueeze(1))
+            assert torch.allclose(results['dist'].logits[t], step['dist'].logits, atol=1e-5)
+            assert torch.allclose(results['value'][t], step['value'], atol=1e-5)
+            step_memory = step['memory']
+        assert torch.allclose(results['memory'], step_memory, atol=1e-5)
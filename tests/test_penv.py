@@ -0,0 +1,91 @@
+"""
+Check that every mode of ParallelEnv gives the same results as the plain one.
+"""
+
+import functools
+import sys
+import numpy
+import pytest
+
+from babyai.rl.utils.dictlist import DictList
+from babyai.rl.utils.penv import ParallelEnv, make_env
+
+# A small level, so that episodes end, and the environments are reset, during the steps
+ENV_NAME = 'BabyAI-GoToObjS4-v0'
+NUM_ENVS = 5
+NUM_STEPS = 40
+
+
+def make_envs():
+    return [functools.partial(make_env, ENV_NAME, 100 + i) for i in range(NUM_ENVS)]
+
+
+def actions_per_step():
+    rng = numpy.random.RandomState(0)
+    return [rng.randint(0, 7, size=NUM_ENVS) for _ in range(NUM_STEPS)]
+
+
+def normalize(obss, rewards, dones):
+    if isinstance(obss, DictList):
+        obss = [{"image": image, "direction": direction, "mission": mission}
+                for image, direction, mission in zip(obss.image, obss.direction, obss.mission)]
+    obss = [(obs["image"].tolist(), int(obs["direction"]), obs["mission"]) for obs in obss]
+    return obss, [float(reward) for reward in rewards], [bool(done) for done in dones]
+
+
+def run_step(penv):
+    results = [normalize(penv.reset(), [0.] * NUM_ENVS, [False] * NUM_ENVS)]
+    for actions in actions_per_step():
+        obss, rewards, dones, _ = penv.step(actions)
+        results.append(normalize(obss, rewards, dones))
+    return results
+
+
+def run_send_recv(penv, min_ready):
+    results = [normalize(penv.reset(), [0.] * NUM_ENVS, [False] * NUM_ENVS)]
+    for actions in actions_per_step():
+        penv.send(actions, range(NUM_ENVS))
+        step = [None] * NUM_ENVS
+        while any(result is None for result in step):
+            obss, rewards, dones, _, env_ids = penv.recv(min_ready)
+            for env_id, result in zip(env_ids, zip(*normalize(obss, rewards, dones))):
+                step[env_id] = result
+        results.append(tuple(list(values) for values in zip(*step)))
+    return results
+
+
+@pytest.fixture(scope="module")
+def expected():
+    results = run_step(ParallelEnv(make_envs()))
+    assert any(any(dones) for _, _, dones in results)
+    return results
+
+
+@pytest.mark.parametrize("shared_memory", [False, True])
+@pytest.mark.parametrize("envs_per_proc", [1, 2, 3, NUM_ENVS])
+@pytest.mark.parametrize("batched_obs", [False, True])
+def test_step(expected, shared_memory, envs_per_proc, batched_obs):
+    penv = ParallelEnv(make_envs(), shared_memory, envs_per_proc, batched_obs=batched_obs)
+    assert run_step(penv) == expected
+
+
+@pytest.mark.parametrize("shared_memory", [False, True])
+@pytest.mark.parametrize("envs_per_proc", [1, 2])
+@pytest.mark.parametrize("min_ready", [1, 3, NUM_ENVS])
+def test_send_recv(expected, shared_memory, envs_per_proc, min_ready):
+    penv = ParallelEnv(make_envs(), shared_memory, envs_per_proc)
+    assert run_send_recv(penv, min_ready) == expected
+
+
+def test_pregenerate(expected):
+    penv = ParallelEnv(make_envs(), envs_per_proc=2, pregenerate=2)
+    assert run_step(penv) == expected
+
+
+def test_pregenerate_switch_interval():
+    switch_interval = sys.getswitchinterval()
+    penv = ParallelEnv(make_envs(), envs_per_proc=2, pregenerate=2)
+    penv.reset()
+    penv.step([0] * NUM_ENVS)
+    assert sys.getswitchinterval() == switch_interval
+    penv.close()
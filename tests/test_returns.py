@@ -0,0 +1,83 @@
+"""
+Check the advantages and returns of babyai.rl.utils.returns against per-step loops.
+"""
+
+import pytest
+import torch
+
+from babyai.rl.utils import returns
+
+T, P = 20, 6
+DISCOUNT = 0.99
+
+
+@pytest.fixture
+def rollout():
+    generator = torch.Generator().manual_seed(0)
+    rewards = torch.rand(T, P, generator=generator)
+    values = torch.rand(T, P, generator=generator)
+    # Episodes end in the middle of the rollout
+    next_masks = (torch.rand(T, P, generator=generator) > 0.2).float()
+    next_value = torch.rand(P, generator=generator)
+    assert (next_masks[:-1] == 0).any()
+    return rewards, values, next_masks, next_value
+
+
+def gae_loop(rewards, values, next_masks, next_value, discount, gae_lambda):
+    """The GAE loop that `BaseAlgo.collect_experiences` used to run, where
+    `masks[t]` is `next_masks[t - 1]` and `mask` is `next_masks[T - 1]`."""
+    masks = torch.cat((torch.ones(1, P), next_masks[:-1]))
+    mask = next_masks[-1]
+    advantages = torch.zeros(T, P)
+    for i in reversed(range(T)):
+        next_mask = masks[i+1] if i < T - 1 else mask
+        next_value_ = values[i+1] if i < T - 1 else next_value
+        next_advantage = advantages[i+1] if i < T - 1 else 0
+
+        delta = rewards[i] + discount * next_value_ * next_mask - values[i]
+        advantages[i] = delta + discount * gae_lambda * next_advantage * next_mask
+    return advantages
+
+
+def nstep_loop(rewards, values, next_masks, next_value, discount, n_steps):
+    advantages = torch.zeros(T, P)
+    for t in range(T):
+        for p in range(P):
+            ret, factor = 0., 1.
+            for k in range(t, min(t + n_steps, T)):
+                ret += factor * rewards[k, p]
+                factor *= discount * next_masks[k, p]
+            bootstrap = values[t + n_steps, p] if t + n_steps < T else next_value[p]
+            advantages[t, p] = ret + factor * bootstrap - values[t, p]
+    return advantages
+
+
+@pytest.mark.parametrize("gae_lambda", [0., 0.95, 1.])
+def test_gae(rollout, gae_lambda):
+    expected = gae_loop(*rollout, DISCOUNT, gae_lambda)
+    assert torch.allclose(returns.compute_gae(*rollout, DISCOUNT, gae_lambda), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("n_steps", [1, 3, T])
+def test_nstep(rollout, n_steps):
+    expected = nstep_loop(*rollout, DISCOUNT, n_steps)
+    advantages = returns.compute_nstep_advantages(*rollout, DISCOUNT, n_steps)
+    assert torch.allclose(advantages, expected, atol=1e-5)
+
+
+def test_vtrace_on_policy(rollout):
+    # With ratios of 1, the V-trace targets are the returns until the end of the rollout
+    values = rollout[1]
+    vs, advantages = returns.compute_vtrace(*rollout, torch.zeros(T, P), DISCOUNT)
+    nstep_advantages = nstep_loop(*rollout, DISCOUNT, T)
+    assert torch.allclose(vs, values + nstep_advantages, atol=1e-5)
+    assert torch.allclose(advantages, nstep_advantages, atol=1e-5)
+    assert torch.allclose(advantages, gae_loop(*rollout, DISCOUNT, 1.), atol=1e-5)
+
+
+def test_vtrace_clipping(rollout):
+    # The ratios above 1 are clipped, so V-trace is on-policy if all the ratios are
+    on_policy = returns.compute_vtrace(*rollout, torch.zeros(T, P), DISCOUNT)
+    clipped = returns.compute_vtrace(*rollout, torch.full((T, P), 0.5), DISCOUNT)
+    for expected, result in zip(on_policy, clipped):
+        assert torch.allclose(result, expected, atol=1e-5)
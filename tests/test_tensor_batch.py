@@ -0,0 +1,76 @@
+"""
+Check the indexing, in-place filling and reshaping of TensorBatch.
+"""
+
+import pickle
+import torch
+
+from babyai.rl.utils import TensorBatch
+
+
+def make_batch():
+    return TensorBatch.zeros((4, 3), {"image": ((7, 7, 3), torch.uint8), "direction": ((), torch.long)})
+
+
+def test_zeros():
+    batch = make_batch()
+    assert batch.shape == (4, 3)
+    assert len(batch) == 4
+    assert batch.image.shape == (4, 3, 7, 7, 3) and batch.image.dtype == torch.uint8
+    assert batch["direction"].shape == (4, 3) and batch.direction.dtype == torch.long
+    assert "image" in batch and "instr" not in batch
+
+
+def test_indexing():
+    batch = make_batch()
+    assert batch[1].shape == (3,)
+    assert batch[1:3].shape == (2, 3)
+    assert batch[:, 0].shape == (4,)
+    assert batch[torch.tensor([[0, 1], [2, 3]])].shape == (2, 2, 3)
+
+    # Integers and slices give views
+    batch[1].direction[2] = 5
+    batch[2:].image[0, 0] = 1
+    assert batch.direction[1, 2] == 5
+    assert (batch.image[2, 0] == 1).all() and (batch.image[3] == 0).all()
+
+
+def test_setitem():
+    batch = make_batch()
+    step = TensorBatch({"image": torch.ones(3, 7, 7, 3, dtype=torch.uint8),
+                        "direction": torch.arange(3)})
+    batch[2] = step
+    assert (batch.image[2] == 1).all() and batch.image.sum() == step.image.sum()
+    assert batch.direction[2].tolist() == [0, 1, 2]
+
+    batch["instr"] = torch.zeros(4, 3, 5)
+    assert batch.instr.shape == (4, 3, 5)
+
+
+def test_reshape_transpose():
+    batch = make_batch()
+    batch.direction.copy_(torch.arange(12).view(4, 3))
+
+    transposed = batch.transpose(0, 1)
+    assert transposed.shape == (3, 4)
+    assert transposed.direction[2, 1] == batch.direction[1, 2]
+
+    flat = transposed.reshape(-1)
+    assert flat.shape == (12,) and flat.image.shape == (12, 7, 7, 3)
+    assert flat.direction.tolist() == batch.direction.t().reshape(-1).tolist()
+
+
+def test_nested():
+    batch = make_batch()
+    batch.aux = TensorBatch({"seen": torch.zeros(4, 3, 2)}, batch_ndim=2)
+    flat = batch.reshape(12)
+    assert flat.aux.shape == (12,) and flat.aux.seen.shape == (12, 2)
+    assert flat[3].aux.seen.shape == (2,)
+
+
+def test_pickle():
+    batch = make_batch()
+    batch.direction.fill_(2)
+    batch = pickle.loads(pickle.dumps(batch))
+    assert batch.shape == (4, 3)
+    assert (batch.direction == 2).all()